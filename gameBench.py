@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+# gameBench.py
+#
+# Headless load generator for the game server. Plays complete games
+# between scripted Player servants, with scripted Spectators watching,
+# and reports throughput and latency percentiles for newGame, joinGame,
+# play and end-to-end spectator notification (from the start of the
+# play() call to the spectator receiving the move).
+#
+# usage: gameBench.py [-games N] [-concurrency N] [-spectators N]
+#                     [-workers N] [-timeout seconds] [-json file]
+#                     [-factory uri] [ORB options]
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from queue import Queue
+import CORBA
+import TicTacToe
+
+from gameSession import FACTORY_URI, PlayerSession, SpectatorSession, \
+    connect
+
+GAMES       = 1000  # Total number of games to play
+CONCURRENCY = 100   # Games in progress at once
+SPECTATORS  = 2     # Spectators per game
+WORKERS     = 16    # Threads making play() calls
+TIMEOUT     = 600   # Seconds before giving up on unfinished games
+
+
+class LatencyRecorder:
+    """Collects latency samples, in seconds, for a set of operations."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, op, latency):
+        with self.lock:
+            self.samples.setdefault(op, []).append(latency)
+
+    def error(self, what):
+        with self.lock:
+            self.errors[what] = self.errors.get(what, 0) + 1
+
+    def summary(self):
+        """Return {op: {count, p50, p99, p999, max}}, in milliseconds."""
+        ret = {}
+        with self.lock:
+            for op, samples in self.samples.items():
+                samples = sorted(samples)
+                n = len(samples)
+
+                def pct(p):
+                    return samples[min(n - 1, int(p * n))] * 1000
+
+                ret[op] = {"count": n, "p50": pct(0.5), "p99": pct(0.99),
+                           "p999": pct(0.999), "max": samples[-1] * 1000}
+        return ret
+
+
+class BenchGame:
+    """One game being played by the benchmark."""
+
+    def __init__(self, bench, name):
+        self.bench = bench
+        self.name = name
+        self.sent = {}     # Move seq -> time play() was called
+        self.sessions = []
+        self.done = False
+        self.lock = threading.Lock()
+
+    def finish(self, outcome):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        self.bench.gameFinished(self, outcome)
+
+
+class BenchPlayer(PlayerSession):
+    """A player that plays a random free square whenever it is its go.
+    The play() call itself is made by one of the bench's workers, not
+    in the callback."""
+
+    def __init__(self, client, game_obj, game):
+        super().__init__(client, game_obj)
+        self.bench_game = game
+
+    def onEvent(self, event):
+        if event.kind == "yourGo":
+            self.bench_game.bench.work.put(self)
+        elif event.kind == "end":
+            self.bench_game.finish("completed")
+        elif event.kind == "aborted":
+            self.bench_game.finish("aborted")
+
+    def playRandom(self):
+        game = self.bench_game
+        free = [(x, y) for x in range(3) for y in range(3)
+                if self.board[x][y] == TicTacToe.Nobody]
+        x, y = random.choice(free)
+        start = time.perf_counter()
+        game.sent[self.seq + 1] = start
+
+        try:
+            self.play(x, y)
+            game.bench.recorder.record("play", time.perf_counter() - start)
+
+        except (TicTacToe.GameController.SquareOccupied,
+                TicTacToe.GameController.NotYourGo,
+                TicTacToe.GameController.InvalidCoordinates) as ex:
+            game.bench.recorder.error("play: " + CORBA.id(ex))
+
+        except CORBA.SystemException as ex:
+            game.bench.recorder.error("play: " + CORBA.id(ex))
+            game.finish("failed")
+
+
+class BenchSpectator(SpectatorSession):
+    """A spectator that records how long each move took to reach it."""
+
+    def __init__(self, client, game_obj, game):
+        super().__init__(client, game_obj)
+        self.bench_game = game
+
+    def onEvent(self, event):
+        if event.kind in ("update", "end"):
+            sent = self.bench_game.sent.get(self.seq)
+            if sent is not None:
+                self.bench_game.bench.recorder.record(
+                    "notify", time.perf_counter() - sent)
+
+
+class Bench:
+    def __init__(self, client, games, concurrency, spectators, workers):
+        self.client = client
+        self.games = games
+        self.spectators = spectators
+        self.recorder = LatencyRecorder()
+        self.slots = threading.Semaphore(concurrency)
+        self.work = Queue(0)
+        self.outcomes = {}
+        self.stopped = False  # Outcomes are no longer counted
+        self.lock = threading.Lock()
+        self.finished = threading.Semaphore(0)
+
+        for i in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            player = self.work.get()
+            try:
+                player.playRandom()
+            except Exception as ex:
+                # Keep the worker, and the run, going
+                self.recorder.error("play: " + type(ex).__name__)
+                player.bench_game.finish("failed")
+
+    def _timed(self, op, func, *args):
+        start = time.perf_counter()
+        ret = func(*args)
+        self.recorder.record(op, time.perf_counter() - start)
+        return ret
+
+    def startGame(self, name):
+        game = BenchGame(self, name)
+        game_obj = None
+        try:
+            game_obj = self._timed("newGame", self.client.newGame, name)
+
+            for i in range(self.spectators):
+                spectator = BenchSpectator(self.client, game_obj, game)
+                game.sessions.append(spectator)
+                spectator.watch()
+
+            for i in range(2):
+                player = BenchPlayer(self.client, game_obj, game)
+                game.sessions.append(player)
+                self._timed("joinGame", player.join)
+
+        except (TicTacToe.GameFactory.NameInUse,
+                TicTacToe.Game.CannotJoin,
+                CORBA.SystemException) as ex:
+            self.recorder.error("start: " + CORBA.id(ex))
+            game.finish("failed")
+
+            # Don't leave the game behind in the server under test
+            if game_obj is not None:
+                try:
+                    game_obj.kill()
+                except CORBA.SystemException:
+                    pass
+
+    def gameFinished(self, game, outcome):
+        for session in game.sessions:
+            session.detach()
+
+        with self.lock:
+            if not self.stopped:
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+        self.slots.release()
+        self.finished.release()
+
+    def run(self, timeout=TIMEOUT):
+        """Play the games, giving up on any not finished within timeout
+        seconds. Returns the elapsed time."""
+        prefix = "bench-%d-%d" % (os.getpid(), int(time.time()))
+        start = time.perf_counter()
+        deadline = start + timeout
+
+        def left():
+            return max(0.0, deadline - time.perf_counter())
+
+        finished = 0
+        for i in range(self.games):
+            if not left() or not self.slots.acquire(timeout=left()):
+                break
+            self.startGame("%s-%d" % (prefix, i))
+
+        while finished < self.games and self.finished.acquire(timeout=left()):
+            finished += 1
+
+        with self.lock:
+            self.stopped = True
+            if finished < self.games:
+                print("Timed out with %d games unfinished" %
+                      (self.games - finished))
+                self.outcomes["unfinished"] = self.games - finished
+
+        return time.perf_counter() - start
+
+    def results(self, elapsed):
+        latency = self.recorder.summary()
+        moves = latency.get("play", {}).get("count", 0)
+        return {
+            "config": {"games": self.games, "spectators": self.spectators},
+            "elapsed": elapsed,
+            "outcomes": self.outcomes,
+            "games_per_sec": self.outcomes.get("completed", 0) / elapsed,
+            "moves_per_sec": moves / elapsed,
+            "latency_ms": latency,
+            "errors": self.recorder.errors,
+        }
+
+
+def report(results):
+    print("%d games in %.2f s: %.1f games/s, %.1f moves/s" % (
+        results["config"]["games"], results["elapsed"],
+        results["games_per_sec"], results["moves_per_sec"]))
+    print("Outcomes:", results["outcomes"])
+
+    print("%-10s %8s %9s %9s %9s %9s" % ("op", "count", "p50 ms", "p99 ms",
+                                         "p999 ms", "max ms"))
+    for op, s in sorted(results["latency_ms"].items()):
+        print("%-10s %8d %9.2f %9.2f %9.2f %9.2f" % (
+            op, s["count"], s["p50"], s["p99"], s["p999"], s["max"]))
+
+    for what, count in sorted(results["errors"].items()):
+        print("Error %s: %d" % (what, count))
+
+
+def getOption(argv, option, default=None):
+    """Return the value following option in argv, or default."""
+    if option in argv:
+        return argv[argv.index(option) + 1]
+    return default
+
+
+def main(argv):
+    games = int(getOption(argv, "-games", GAMES))
+    concurrency = int(getOption(argv, "-concurrency", CONCURRENCY))
+    spectators = int(getOption(argv, "-spectators", SPECTATORS))
+    workers = int(getOption(argv, "-workers", WORKERS))
+    timeout = float(getOption(argv, "-timeout", TIMEOUT))
+    json_file = getOption(argv, "-json")
+    uri = getOption(argv, "-factory", FACTORY_URI)
+
+    try:
+        client = connect(argv, uri)
+
+    except CORBA.SystemException as ex:
+        print("Cannot find the GameFactory:")
+        print("  ", CORBA.id(ex), ex)
+        sys.exit(1)
+
+    bench = Bench(client, games, concurrency, spectators, workers)
+    results = bench.results(bench.run(timeout))
+    report(results)
+
+    if json_file:
+        with open(json_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    client.orb.destroy()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
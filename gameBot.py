@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# gameBot.py
+#
+# Computer player for the game server. Its moves come from a table of
+# the best move in every reachable position, worked out once by a full
+# minimax search, so each reply is a single lookup.
+#
+# A position is indexed by noughts | crosses << 9, where noughts and
+# crosses are the 9-bit masks of the squares each side holds, with
+# square (x, y) at bit 3 * x + y, as in Game_i. The table holds the
+# best square for the side to move, or NO_SQUARE for positions that
+# cannot be reached or are already over.
+#
+# Run as a script to write the table to a file, for loading with
+# loadTable() or the server's -botTable option.
+
+import os
+import sys
+import threading
+import zlib
+import TicTacToe
+
+NAME = "computer"  # The computer player's name in the results
+
+NO_SQUARE = 0xff
+TABLE_SIZE = 1 << 18
+FULL_BOARD = 0x1ff
+
+LINES = tuple([sum(1 << (3 * x + y) for y in range(3)) for x in range(3)] +
+              [sum(1 << (3 * x + y) for x in range(3)) for y in range(3)] +
+              [1 << 0 | 1 << 4 | 1 << 8, 1 << 2 | 1 << 4 | 1 << 6])
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def _won(mask):
+    for line in LINES:
+        if mask & line == line:
+            return True
+    return False
+
+
+def computeTable():
+    """Return the move table, as a bytearray of TABLE_SIZE entries."""
+
+    table = bytearray([NO_SQUARE]) * TABLE_SIZE
+    scores = {}
+
+    def solve(noughts, crosses):
+        """Return the score of a position for the side to move, and
+        record its best move. A win scores more the sooner it comes."""
+
+        key = noughts | crosses << 9
+        score = scores.get(key)
+        if score is not None:
+            return score
+
+        noughts_go = bin(noughts).count("1") == bin(crosses).count("1")
+        if noughts_go:
+            mine, theirs = noughts, crosses
+        else:
+            mine, theirs = crosses, noughts
+
+        best = best_square = None
+        for square in range(9):
+            bit = 1 << square
+            if (mine | theirs) & bit:
+                continue
+
+            played = mine | bit
+            if _won(played):
+                score = 10 - bin(played | theirs).count("1")
+            elif played | theirs == FULL_BOARD:
+                score = 0
+            elif noughts_go:
+                score = -solve(played, crosses)
+            else:
+                score = -solve(noughts, played)
+
+            if best is None or score > best:
+                best, best_square = score, square
+
+        table[key] = best_square
+        scores[key] = best
+        return best
+
+    solve(0, 0)
+    return table
+
+
+def loadTable(path=None):
+    """Set up the move table. If path names an existing file, the table
+    is read from it, otherwise it is computed, and written to path if
+    one was given. Returns the table."""
+
+    global _table
+
+    with _table_lock:
+        if _table is not None:
+            return _table
+
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                table = bytearray(zlib.decompress(f.read()))
+            if len(table) != TABLE_SIZE:
+                raise ValueError("%s is not a move table" % path)
+        else:
+            table = computeTable()
+            if path:
+                with open(path, "wb") as f:
+                    f.write(zlib.compress(bytes(table), 9))
+
+        _table = table
+        return table
+
+
+class ComputerPlayer:
+    """A Player that lives inside the server. The game calls it like
+    any other player, through its outbox, and it replies by making its
+    move directly on the game."""
+
+    def __init__(self, game):
+        self.game = game
+        self.ptype = TicTacToe.Nobody  # Set when it joins
+        self.table = loadTable()
+
+    def _move(self):
+        game = self.game
+        if game is None:
+            return
+
+        square = self.table[game.noughts | game.crosses << 9]
+        if square == NO_SQUARE:
+            return
+
+        try:
+            game._play(square // 3, square % 3, self.ptype)
+        except (TicTacToe.GameController.NotYourGo,
+                TicTacToe.GameController.SquareOccupied):
+            # The game has moved on, or been killed, since our go
+            pass
+
+    def yourGo(self, state):
+        self._move()
+
+    def yourGoMove(self, last):
+        self._move()
+
+    def end(self, state, winner):
+        self.game = None
+
+    def endMove(self, last, winner):
+        self.game = None
+
+    def gameAborted(self):
+        self.game = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: %s <table file>" % sys.argv[0])
+        sys.exit(1)
+
+    loadTable(sys.argv[1])
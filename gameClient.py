@@ -1,29 +1,46 @@
-
 #!/usr/bin/env python
 
 # gameClient.py
+#
+# Tk front-end for the game server, built on the gameSession library.
 
 import sys
 import threading
 from tkinter import *
 from omniORB import CORBA
-import PortableServer
 import TicTacToe
-import TicTacToe__POA
+
+from gameSession import LobbySession, PlayerSession, SpectatorSession, \
+    connect
+
+# The GameFactory to use, unless one is given with -factory, which
+# takes an IOR or a corbaname URI such as
+# corbaname::localhost#tutorial/GameFactory
+GAMEFACTORY_IOR = "IOR:010000001e00000049444c3a546963546163546f652f47616d65466163746f72793a312e30000000010000000000000064000000010102000e0000003139322e3136382e312e3130350061eb0e000000fe16da586700003f40000000000000000200000000000000080000000100000000545441010000001c00000001000000010001000100000001000105090101000100000009010100"
 
 
 class GameBrowser:
     """This class implements a top-level user interface to the game
-    player. It lists the games currently running in the GameFactory.
-    The user can choose to create new games, and join, watch or kill
-    existing games."""
-
-    def __init__(self, orb, poa, gameFactory):
-        self.orb = orb
-        self.poa = poa
-        self.gameFactory = gameFactory
+    player. It lists the games currently running in the GameFactory,
+    kept up to date by the factory's lobby change feed. The user can
+    choose to create new games, and join, watch or kill existing
+    games."""
+
+    def __init__(self, client, player_name=""):
+        self.client = client
+        self.player_name = player_name  # Results are recorded under it
+        self.gameList = []  # GameInfo of each entry in the Listbox
+
+        # Lobby changes waiting to be shown. They arrive on ORB threads,
+        # and only the Tk thread touches gameList and the widgets.
+        self.changed = {}  # Names of the changed games, in order
+        self.rebuild = False
+        self.scheduled = False
+        self.lock = threading.Lock()
+
         self.initGui()
-        self.getGameList()
+        self.lobby = LobbySession(client, self.lobbyChanged)
+        self.update()
         print("GameBrowser initialized")
 
     def initGui(self):
@@ -55,11 +72,13 @@ class GameBrowser:
         listframe.grid(row=0, column=0, rowspan=6)
 
         # Padding
-        Frame(frame, width=20).grid(row=0, column=1, rowspan=6)
+        Frame(frame, width=20).grid(row=0, column=1, rowspan=7)
 
         # Buttons
         newbutton = Button(frame, text="New game", command=self.newGame)
         joinbutton = Button(frame, text="Join game", command=self.joinGame)
+        computerbutton = Button(frame, text="Play computer",
+                                command=self.playComputer)
         watchbutton = Button(frame, text="Watch game", command=self.watchGame)
         killbutton = Button(frame, text="Kill game", command=self.killGame)
         updatebutton = Button(frame, text="Update list", command=self.update)
@@ -68,6 +87,7 @@ class GameBrowser:
         for button in [
             newbutton,
             joinbutton,
+            computerbutton,
             watchbutton,
             killbutton,
             updatebutton,
@@ -80,15 +100,16 @@ class GameBrowser:
 
         newbutton.grid(row=0, column=2)
         joinbutton.grid(row=1, column=2)
-        watchbutton.grid(row=2, column=2)
-        killbutton.grid(row=3, column=2)
-        updatebutton.grid(row=4, column=2)
-        quitbutton.grid(row=5, column=2)
+        computerbutton.grid(row=2, column=2)
+        watchbutton.grid(row=3, column=2)
+        killbutton.grid(row=4, column=2)
+        updatebutton.grid(row=5, column=2)
+        quitbutton.grid(row=6, column=2)
 
         self.newGameDialogue = None
 
         # Padding at bottom
-        Frame(frame, height=10).grid(row=6, columnspan=3)
+        Frame(frame, height=10).grid(row=7, columnspan=3)
 
         # Status bar
         self.statusbar = Label(self.master, text="", bd=1, relief=SUNKEN, anchor=W)
@@ -97,40 +118,78 @@ class GameBrowser:
         frame.pack(side=TOP)
 
     def getGameList(self):
-        """Get the list of games from the GameFactory, and populate
-        the Listbox in the GUI"""
+        """Populate the Listbox in the GUI from the whole lobby"""
 
-        self.gameList = []
+        games = self.lobby.listGames()
+        self.gameList = [game.game for game in games]
         self.listbox.delete(0, END)
+        self.listbox.insert(END, *[gameLabel(game) for game in games])
 
-        try:
-            seq, iterator = self.gameFactory.listGames(0)
-        except CORBA.SystemException as ex:
-            print("System exception contacting GameFactory:")
-            print("  ", CORBA.id(ex), ex)
-            return
+        if not self.gameList:
+            print("No games in the GameFactory")
 
-        if len(seq) > 0:
-            print("listGames() did not return an empty sequence as it should")
+        print("Game list: %d games" % len(self.gameList))
 
-        if iterator is None:
-            print("No games in the GameFactory")
-            return
+    def lobbyChanged(self, lobby, changes):
+        """Called by the LobbySession. Only the entries of the games
+        that have changed are updated, by showChanges() on the Tk
+        thread."""
 
-        try:
-            more = True
-            while more:
-                seq, more = iterator.next_n(1)
+        with self.lock:
+            if changes is None:
+                self.rebuild = True
+                self.changed.clear()
+            elif not self.rebuild:
+                for change in changes:
+                    self.changed[change.game.game.name] = None
 
-                for info in seq:
-                    self.gameList.append(info)
-                    self.listbox.insert(END, info.name)
+            schedule = not self.scheduled
+            self.scheduled = True
 
-            iterator.destroy()
+        if schedule:
+            self.master.after(0, self.showChanges)
 
-        except CORBA.SystemException as ex:
-            print("System exception contacting GameIterator:")
-            print("  ", CORBA.id(ex), ex)
+    def showChanges(self):
+        with self.lock:
+            rebuild, changed = self.rebuild, self.changed
+            self.rebuild = False
+            self.changed = {}
+            self.scheduled = False
+
+        try:
+            if rebuild:
+                self.getGameList()
+            else:
+                for name in changed:
+                    self.updateEntry(name)
+
+        except TclError:
+            # The window has been closed
+            pass
+
+    def updateEntry(self, name):
+        game = self.lobby.find(name)
+        index = None
+        for i, info in enumerate(self.gameList):
+            if info.name == name:
+                index = i
+                break
+
+        if game is None:
+            if index is not None:
+                del self.gameList[index]
+                self.listbox.delete(index)
+
+        elif index is None:
+            self.gameList.append(game.game)
+            self.listbox.insert(END, gameLabel(game))
+
+        else:
+            selected = index in [int(i) for i in self.listbox.curselection()]
+            self.listbox.delete(index)
+            self.listbox.insert(index, gameLabel(game))
+            if selected:
+                self.listbox.selection_set(index)
 
     def statusMessage(self, msg):
         self.statusbar.config(text=msg)
@@ -144,19 +203,15 @@ class GameBrowser:
         index = int(selection[0])
         info = self.gameList[index]
 
-        try:
-            players = info.obj._get_players()
-            if players == 0:
-                msg = "No players yet"
-            elif players == 1:
-                msg = "One player waiting"
-            else:
-                msg = "Game in progress"
-
-        except CORBA.SystemException as ex:
-            print("System exception contacting Game:")
-            print("  ", CORBA.id(ex), ex)
-            msg = "Error contacting Game object"
+        game = self.lobby.find(info.name)
+        if game is None:
+            msg = "Game over"
+        elif game.players == 0:
+            msg = "No players yet"
+        elif game.players == 1:
+            msg = "One player waiting"
+        else:
+            msg = "Game in progress"
 
         self.statusMessage(f"{info.name}: {msg}")
 
@@ -191,7 +246,7 @@ class GameBrowser:
             return
 
         try:
-            self.gameFactory.newGame(name)
+            self.client.newGame(name)
 
         except TicTacToe.GameFactory.NameInUse:
             self.statusMessage("Game name in use")
@@ -203,40 +258,43 @@ class GameBrowser:
             self.statusMessage("System exception trying to create new game")
             return
 
-        self.getGameList()
+    def playComputer(self):
+        self.joinGame(computer=True)
 
-    def joinGame(self):
+    def joinGame(self, computer=False):
         selection = self.listbox.curselection()
         if selection == (): return
 
         index = int(selection[0])
         info = self.gameList[index]
 
-        pi = Player_i(self.master, info.name)
-        id = poa.activate_object(pi)
-        po = poa.id_to_reference(id)
+        pi = Player_i(self.client, info.obj, self.master, info.name)
         try:
-            controller, type = info.obj.joinGame(po)
-            if type == TicTacToe.Nought:
+            pi.join(self.player_name)
+            if pi.ptype == TicTacToe.Nought:
                 stype = "noughts"
             else:
                 stype = "crosses"
 
-            pi.go(info.obj, controller, stype)
+            pi.go(stype)
 
-            self.statusMessage("%s: joined game as %s" % (info.name, stype))
+            # If someone was already waiting, they are our opponent
+            if computer and pi.ptype == TicTacToe.Nought:
+                info.obj.addComputerPlayer()
+                self.statusMessage("%s: playing the computer as %s" %
+                                   (info.name, stype))
+            else:
+                self.statusMessage("%s: joined game as %s" %
+                                   (info.name, stype))
 
         except TicTacToe.Game.CannotJoin as ex:
-            poa.deactivate_object(id)
             self.statusMessage("%s: cannot join game" % info.name)
 
         except CORBA.SystemException as ex:
-            poa.deactivate_object(id)
             print("System exception trying to join game:")
             print("  ", CORBA.id(ex), ex)
             self.statusMessage("%s: system exception contacting game" % \
                                info.name)
-            self.getGameList()
 
     def watchGame(self):
         selection = self.listbox.curselection()
@@ -245,25 +303,28 @@ class GameBrowser:
         index = int(selection[0])
         info = self.gameList[index]
 
-        si = Spectator_i(self.master, info.name)
-        id = poa.activate_object(si)
-        so = poa.id_to_reference(id)
+        si = Spectator_i(self.client, info.obj, self.master, info.name)
         try:
-            cookie, state = info.obj.watchGame(so)
-            si.go(info.obj, cookie, state)
+            si.watch()
+            si.go()
 
             self.statusMessage("Watching %s" % info.name)
 
         except CORBA.SystemException as ex:
-            poa.deactivate_object(id)
             print("System exception trying to watch game:")
             print("  ", CORBA.id(ex), ex)
             self.statusMessage("%s: system exception contacting game" % \
                                info.name)
-            self.getGameList()
 
     def update(self):
-        self.getGameList()
+        """Subscribe to the lobby again, for a fresh list"""
+        try:
+            self.lobby.subscribe()
+
+        except CORBA.SystemException as ex:
+            print("System exception subscribing to the lobby:")
+            print("  ", CORBA.id(ex), ex)
+            self.statusMessage("System exception listing games")
 
     def killGame(self):
         selection = self.listbox.curselection()
@@ -282,60 +343,165 @@ class GameBrowser:
             msg = "error contacting object"
 
         self.statusMessage("%s: %s" % (info.name, msg))
-        self.getGameList()
 
-class Player_i(TicTacToe__POA.Player):
 
-    def __init__(self, master, name):
+def gameLabel(game):
+    """Return the Listbox entry for a LobbyGame"""
+    return "%s (%d/2)" % (game.game.name, game.players)
+
+
+class BoardCanvas:
+    """The board in a game window.
+
+    Each square's value and canvas items are cached, so a redraw only
+    replaces the items of the squares that have changed, and the canvas
+    never holds more than the grid and one piece per square. Redraws
+    are batched: drawState() records the latest state, and the canvas
+    is brought up to date once Tk is idle, however many states arrived
+    in the meantime."""
+
+    def __init__(self, master):
+        self.canvas = Canvas(master, width=300, height=300)
+        self.canvas.pack()
+
+        self.canvas.create_line(100, 0, 100, 300, width=5)
+        self.canvas.create_line(200, 0, 200, 300, width=5)
+        self.canvas.create_line(0, 100, 300, 100, width=5)
+        self.canvas.create_line(0, 200, 300, 200, width=5)
+
+        n = TicTacToe.Nobody
+        self.cells = [[n, n, n], [n, n, n], [n, n, n]]
+        self.items = [[(), (), ()], [(), (), ()], [(), (), ()]]
+
+        # State waiting to be drawn. Events arrive on ORB threads.
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def drawState(self, state):
+        with self.lock:
+            schedule = self.pending is None
+            self.pending = state
+
+        if schedule:
+            self.canvas.after_idle(self.redraw)
+
+    def redraw(self):
+        with self.lock:
+            state = self.pending
+            self.pending = None
+
+        try:
+            for i in range(3):
+                for j in range(3):
+                    if state[i][j] != self.cells[i][j]:
+                        self.drawCell(i, j, state[i][j])
+
+        except TclError:
+            # The window has been closed
+            pass
+
+    def drawCell(self, x, y, value):
+        for item in self.items[x][y]:
+            self.canvas.delete(item)
+
+        if value == TicTacToe.Nought:
+            items = self.drawNought(x, y)
+        elif value == TicTacToe.Cross:
+            items = self.drawCross(x, y)
+        else:
+            items = ()
+
+        self.cells[x][y] = value
+        self.items[x][y] = items
+
+    def drawNought(self, x, y):
+        cx = x * 100 + 20
+        cy = y * 100 + 20
+        return (self.canvas.create_oval(cx, cy, cx + 60, cy + 60,
+                                        outline="darkgreen", width=5),)
+
+    def drawCross(self, x, y):
+        cx = x * 100 + 30
+        cy = y * 100 + 30
+        return (self.canvas.create_line(cx, cy, cx + 40, cy + 40,
+                                        fill="darkred", width=5),
+                self.canvas.create_line(cx, cy + 40, cx + 40, cy,
+                                        fill="darkred", width=5))
+
+
+def winnerMessage(winner):
+    if winner == TicTacToe.Nought:
+        return "Noughts wins"
+    elif winner == TicTacToe.Cross:
+        return "Crosses wins"
+    else:
+        return "It's a draw"
+
+
+class Player_i(PlayerSession):
+    """Tk window for a player in a game."""
+
+    def __init__(self, client, game, master, name):
+        super().__init__(client, game)
         self.master = master
         self.name = name
+        self.toplevel = None
+
+        # The first events can arrive between join() and go(), before
+        # there is a window to show them in. They are kept for go().
+        self.early = []
+        self.lock = threading.Lock()
         print("Player_i created")
 
     def __del__(self):
         print("Player_i deleted")
 
-    # CORBA methods
-    def yourGo(self, state):
-        self.drawState(state)
-        self.statusMessage("Your go")
-
-    def end(self, state, winner):
-        self.drawState(state)
-        if winner == TicTacToe.Nought:
-            self.statusMessage("Noughts wins")
-        elif winner == TicTacToe.Cross:
-            self.statusMessage("Crosses wins")
-        else:
-            self.statusMessage("It's a draw")
-        self.toplevel = None
+    # Session events
+    def onEvent(self, event):
+        with self.lock:
+            if self.early is not None:
+                self.early.append(event)
+            else:
+                self.showEvent(event)
 
-    def gameAborted(self):
-        self.statusMessage("Game aborted!")
-        self.toplevel = None
+    def showEvent(self, event):
+        if self.toplevel is None:
+            return
+
+        if event.kind == "yourGo":
+            self.drawState(event.state)
+            self.statusMessage("Your go")
+
+        elif event.kind == "end":
+            self.drawState(event.state)
+            self.statusMessage(winnerMessage(event.winner))
+            self.toplevel = None
+
+        elif event.kind == "aborted":
+            self.statusMessage("Game aborted!")
+            self.toplevel = None
 
     # Implementation details
-    def go(self, game, controller, type):
-        self.game = game
-        self.controller = controller
+    def go(self, type):
         self.type = type
 
         self.toplevel = Toplevel(self.master)
         self.toplevel.title("%s (%s)" % (self.name, type))
 
-        self.canvas = Canvas(self.toplevel, width=300, height=300)
-        self.canvas.pack()
-
-        self.canvas.create_line(100, 0, 100, 300, width=5)
-        self.canvas.create_line(200, 0, 200, 300, width=5)
-        self.canvas.create_line(0, 100, 300, 100, width=5)
-        self.canvas.create_line(0, 200, 300, 200, width=5)
+        self.boardView = BoardCanvas(self.toplevel)
 
-        self.canvas.bind("<ButtonRelease-1>", self.click)
+        self.boardView.canvas.bind("<ButtonRelease-1>", self.click)
         self.toplevel.bind("<Destroy>", self.close)
 
         self.statusbar = Label(self.toplevel,
                                text="", bd=1, relief=SUNKEN, anchor=W)
         self.statusbar.pack(side=BOTTOM, fill=X)
+        self.drawState(self.board)
+
+        with self.lock:
+            early, self.early = self.early, None
+            for event in early:
+                self.showEvent(event)
 
     def statusMessage(self, msg):
         if self.toplevel:
@@ -347,8 +513,7 @@ class Player_i(TicTacToe__POA.Player):
         try:
             self.statusMessage("Waiting for other player...")
 
-            state = self.controller.play(x, y)
-            self.drawState(state)
+            self.drawState(self.play(x, y))
 
         except TicTacToe.GameController.SquareOccupied:
             self.statusMessage("Square already occupied")
@@ -368,86 +533,57 @@ class Player_i(TicTacToe__POA.Player):
         if self.toplevel:
             self.toplevel = None
             try:
-                self.game.kill()
+                super().close()
             except CORBA.SystemException as ex:
                 print("System exception trying to kill game:")
                 print("  ", CORBA.id(ex), ex)
 
-            id = poa.servant_to_id(self)
-            poa.deactivate_object(id)
-
-    def drawNought(self, x, y):
-        cx = x * 100 + 20
-        cy = y * 100 + 20
-        self.canvas.create_oval(cx, cy, cx + 60, cy + 60,
-                                outline="darkgreen", width=5)
-
-    def drawCross(self, x, y):
-        cx = x * 100 + 30
-        cy = y * 100 + 30
-        self.canvas.create_line(cx, cy, cx + 40, cy + 40,
-                                fill="darkred", width=5)
-        self.canvas.create_line(cx, cy + 40, cx + 40, cy,
-                                fill="darkred", width=5)
-
     def drawState(self, state):
-        for i in range(3):
-            for j in range(3):
-                if state[i][j] == TicTacToe.Nought:
-                    self.drawNought(i, j)
-                elif state[i][j] == TicTacToe.Cross:
-                    self.drawCross(i, j)
+        self.boardView.drawState(state)
 
-class Spectator_i(TicTacToe__POA.Spectator):
+class Spectator_i(SpectatorSession):
+    """Tk window for a spectator of a game."""
 
-    def __init__(self, master, name):
+    def __init__(self, client, game, master, name):
+        super().__init__(client, game)
         self.master = master
         self.name = name
+        self.toplevel = None
         print("Spectator_i created")
 
     def __del__(self):
         print("Spectator_i deleted")
 
-    # CORBA methods
-    def update(self, state):
-        self.drawState(state)
+    # Session events
+    def onEvent(self, event):
+        if self.toplevel is None:
+            return
 
-    def end(self, state, winner):
-        self.drawState(state)
-        if winner == TicTacToe.Nought:
-            self.statusMessage("Noughts wins")
-        elif winner == TicTacToe.Cross:
-            self.statusMessage("Crosses wins")
-        else:
-            self.statusMessage("It's a draw")
-        self.toplevel = None
+        if event.kind == "update":
+            self.drawState(event.state)
 
-    def gameAborted(self):
-        self.statusMessage("Game aborted!")
-        self.toplevel = None
+        elif event.kind == "end":
+            self.drawState(event.state)
+            self.statusMessage(winnerMessage(event.winner))
+            self.toplevel = None
 
-    # Implementation details
-    def go(self, game, cookie, state):
-        self.game = game
-        self.cookie = cookie
+        elif event.kind == "aborted":
+            self.statusMessage("Game aborted!")
+            self.toplevel = None
 
+    # Implementation details
+    def go(self):
         self.toplevel = Toplevel(self.master)
         self.toplevel.title("Watching %s" % self.name)
 
-        self.canvas = Canvas(self.toplevel, width=300, height=300)
-        self.canvas.pack()
-
-        self.canvas.create_line(100, 0, 100, 300, width=5)
-        self.canvas.create_line(200, 0, 200, 300, width=5)
-        self.canvas.create_line(0, 100, 300, 100, width=5)
-        self.canvas.create_line(0, 200, 300, 200, width=5)
+        self.boardView = BoardCanvas(self.toplevel)
 
         self.toplevel.bind("<Destroy>", self.close)
 
         self.statusbar = Label(self.toplevel,
                                text="", bd=1, relief=SUNKEN, anchor=W)
         self.statusbar.pack(side=BOTTOM, fill=X)
-        self.drawState(state)
+        self.drawState(self.board)
 
     def statusMessage(self, msg):
         self.statusbar.config(text=msg)
@@ -456,94 +592,64 @@ class Spectator_i(TicTacToe__POA.Spectator):
         if self.toplevel:
             self.toplevel = None
             try:
-                self.game.unwatchGame(self.cookie)
+                super().close()
             except CORBA.SystemException as ex:
                 print("System exception trying to unwatch game:")
                 print("  ", CORBA.id(ex), ex)
 
-            id = poa.servant_to_id(self)
-            poa.deactivate_object(id)
+    def drawState(self, state):
+        self.boardView.drawState(state)
 
-    def drawNought(self, x, y):
-        cx = x * 100 + 20
-        cy = y * 100 + 20
-        self.canvas.create_oval(cx, cy, cx + 60, cy + 60,
-                                outline="darkgreen", width=5)
 
-    def drawCross(self, x, y):
-        cx = x * 100 + 30
-        cy = y * 100 + 30
-        self.canvas.create_line(cx, cy, cx + 40, cy + 40,
-                                fill="darkred", width=5)
-        self.canvas.create_line(cx, cy + 40, cx + 40, cy,
-                                fill="darkred", width=5)
+def main(argv):
+    uri = GAMEFACTORY_IOR
+    if "-factory" in argv:
+        uri = argv[argv.index("-factory") + 1]
 
-    def drawState(self, state):
-        for i in range(3):
-            for j in range(3):
-                if state[i][j] == TicTacToe.Nought:
-                    self.drawNought(i, j)
-                elif state[i][j] == TicTacToe.Cross:
-                    self.drawCross(i, j)
-
-orb = CORBA.ORB_init(sys.argv, CORBA.ORB_ID)
-poa = orb.resolve_initial_references("RootPOA")
-poa._get_the_POAManager().activate()
-
-# Get the GameFactory reference using a corbaname URI. On a pre-CORBA
-# 2.4 ORB, this would have to explicitly contact the naming service.
-try:
-    gameFactory = orb.string_to_object("IOR:010000001e00000049444c3a546963546163546f652f47616d65466163746f72793a312e30000000010000000000000064000000010102000e0000003139322e3136382e312e3130350061eb0e000000fe16da586700003f40000000000000000200000000000000080000000100000000545441010000001c00000001000000010001000100000001000105090101000100000009010100")
-    gameFactory = gameFactory._narrow(TicTacToe.GameFactory)
-
-except CORBA.BAD_PARAM as ex:
-    # string_to_object throws BAD_PARAM if the name cannot be resolved
-    print("Cannot find the GameFactory in the naming service.")
-    sys.exit(1)
-
-except CORBA.SystemException as ex:
-    # This might happen if the naming service is dead, or the narrow
-    # tries to contact the object and it is not there.
-
-    print("CORBA system exception trying to get the GameFactory reference:")
-    print("  ", CORBA.id(ex), ex)
-    sys.exit(1)
-
-# Start the game browser
-browser = GameBrowser(orb, poa, gameFactory)
-
-# Run the Tk mainloop in a separate thread
-# print("asd")
-# def tkloop(self):
-#     browser.master.mainloop()
-#     print("Shutting down the ORB...")
-#     orb.shutdown(0)
-#
-# tkloop(
+    try:
+        client = connect(argv, uri)
 
+    except CORBA.BAD_PARAM as ex:
+        # string_to_object throws BAD_PARAM if the name cannot be resolved
+        print("Cannot find the GameFactory in the naming service.")
+        sys.exit(1)
 
-def orb_loop():
-    """Executa o loop principal do ORB em uma thread separada."""
-    try:
-        orb.run()
-    except KeyboardInterrupt:
-        print("Shutting down ORB...")
-        orb.shutdown(1)
+    except CORBA.SystemException as ex:
+        # This might happen if the naming service is dead, or the narrow
+        # tries to contact the object and it is not there.
 
-# Inicialize a thread do ORB
-orb_thread = threading.Thread(target=orb_loop, daemon=True)
-orb_thread.start()
+        print("CORBA system exception trying to get the GameFactory reference:")
+        print("  ", CORBA.id(ex), ex)
+        sys.exit(1)
 
+    # Start the game browser
+    # Games joined are recorded in the results under -name, if given
+    player_name = ""
+    if "-name" in argv:
+        player_name = argv[argv.index("-name") + 1]
+
+    browser = GameBrowser(client, player_name)
+
+    def orb_loop():
+        """Executa o loop principal do ORB em uma thread separada."""
+        try:
+            client.orb.run()
+        except KeyboardInterrupt:
+            print("Shutting down ORB...")
+            client.orb.shutdown(1)
 
+    # Inicialize a thread do ORB
+    orb_thread = threading.Thread(target=orb_loop, daemon=True)
+    orb_thread.start()
 
-# Execute o loop principal do Tkinter na thread principal
-browser.master.mainloop()
+    # Execute o loop principal do Tkinter na thread principal
+    browser.master.mainloop()
 
-# Após o loop do Tkinter terminar, desligue o ORB
-print("Shutting down the ORB...")
-orb.shutdown(0)
+    # Após o loop do Tkinter terminar, desligue o ORB
+    browser.lobby.close()
+    print("Shutting down the ORB...")
+    client.shutdown()
 
-# Run the ORB main loop (not necessary with omniORBpy, but may be
-# necessary with other ORBs. According to the CORBA specification,
-# orb.run() must be given the main thread.
 
+if __name__ == "__main__":
+    main(sys.argv)
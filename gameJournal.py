@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+# gameJournal.py
+#
+# Durable journal of the games in a server, so that a restarted server
+# can carry on with the games that were in progress.
+#
+# The journal is a directory holding numbered segment files of binary
+# records, journal-<n>, and a snapshot file. Games append their
+# lifecycle and move records to an in-memory buffer, which a writer
+# thread writes to the current segment and fsyncs every SYNC_INTERVAL
+# seconds, so a crash loses at most the last SYNC_INTERVAL of moves.
+#
+# Every SNAPSHOT_INTERVAL seconds a new segment is started, and the
+# state of all the live games is written to a new snapshot, which
+# starts with the number of the segment it goes with. The older
+# segments are then deleted. Recovery reads the snapshot, then replays
+# the segments from its one on, so its cost is bounded by the number
+# of live games and the activity of one snapshot interval, not by the
+# whole history of the server.
+#
+# The snapshot is taken after the new segment has started, so records
+# in that segment may already be reflected in it. Replaying a record
+# is therefore made harmless if its effect is already present: moves
+# carry their sequence numbers, and games their incarnation numbers.
+#
+# Incarnation numbers are never reused, even those of games that have
+# ended and dropped out of the snapshot: the snapshot records the
+# highest one the journal has seen.
+#
+# Each record is a header of type, payload length and CRC-32 of the
+# payload, followed by the payload. A torn or corrupt record, as left
+# by a crash in the middle of a write, ends the segment.
+
+import os
+import struct
+import threading
+import time
+import zlib
+import TicTacToe
+
+from gameLog import log
+import gameMetrics
+
+SYNC_INTERVAL     = 0.05  # Seconds between fsyncs of the journal
+SNAPSHOT_INTERVAL = 60    # Seconds between snapshots
+
+SNAPSHOT_FILE  = "snapshot"
+SEGMENT_PREFIX = "journal-"
+
+# Record types
+NEW, JOIN, MOVE, STATE, END, SEGMENT = range(1, 7)
+
+HEADER = struct.Struct("<BHI")  # Type, payload length, CRC-32
+
+# Payloads. Every one starts with the incarnation of the game.
+GAME_REC  = struct.Struct("<I")        # END, SEGMENT number
+SEGMENT_REC = struct.Struct("<II")     # SEGMENT number, highest
+                                       # incarnation
+NEW_REC   = struct.Struct("<Id")       # Creation time, + name
+JOIN_REC  = struct.Struct("<IBH")      # Player type, name length, +
+                                       # name and IOR
+MOVE_REC  = struct.Struct("<IIBBB")    # seq, x, y, who
+STATE_REC = struct.Struct("<IHHIBBB")  # noughts, crosses, and seq, x, y,
+                                       # who of the last move
+
+PLAYER_TYPES = (TicTacToe.Nobody, TicTacToe.Nought, TicTacToe.Cross)
+PLAYER_CODES = dict((p, i) for i, p in enumerate(PLAYER_TYPES))
+
+RECORDS   = gameMetrics.registry.counter("Journal.records")
+FSYNCS    = gameMetrics.registry.histogram("Journal.fsync")
+SNAPSHOTS = gameMetrics.registry.histogram("Journal.snapshot")
+
+
+class GameRecord:
+    """The state of a game as recovered from the journal. players maps
+    each player type that has joined to the player's stringified object
+    reference, or to "" for a computer player, and player_names maps it
+    to the name the player joined with."""
+
+    def __init__(self, incarnation, name, created):
+        self.incarnation = incarnation
+        self.name = name
+        self.created = created
+        self.players = {}
+        self.player_names = {}
+        self.noughts = 0
+        self.crosses = 0
+        self.last_move = TicTacToe.Move(0, 0, 0, TicTacToe.Nobody)
+
+
+def _record(rtype, payload):
+    if len(payload) > 0xFFFF:
+        raise ValueError("journal record of %d bytes" % len(payload))
+    return HEADER.pack(rtype, len(payload), zlib.crc32(payload)) + payload
+
+
+def _joinRecord(incarnation, ptype, player_name, ior):
+    name = player_name.encode("utf-8")
+    return _record(JOIN, JOIN_REC.pack(incarnation, PLAYER_CODES[ptype],
+                                       len(name)) + name + ior.encode("ascii"))
+
+
+def _records(data):
+    """Yield the (type, payload) pairs in data, up to the first torn or
+    corrupt record."""
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        rtype, length, crc = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        payload = data[pos:pos + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            log.warning("Journal ends with a damaged record")
+            return
+        pos += length
+        yield rtype, payload
+
+
+def _newRecord(incarnation, name, created):
+    return _record(NEW, NEW_REC.pack(incarnation, created) +
+                   name.encode("utf-8"))
+
+
+def gameRecords(game):
+    """Return the records that recreate game, a GameRecord, in a
+    snapshot."""
+    data = [_newRecord(game.incarnation, game.name, game.created)]
+
+    for ptype, ior in game.players.items():
+        data.append(_joinRecord(game.incarnation, ptype,
+                                game.player_names.get(ptype, ""), ior))
+
+    m = game.last_move
+    data.append(_record(STATE, STATE_REC.pack(
+        game.incarnation, game.noughts, game.crosses, m.seq, m.x, m.y,
+        PLAYER_CODES[m.who])))
+    return b"".join(data)
+
+
+class Journal:
+    """Appends game records to the journal in directory, and recovers
+    the games from it. orb is used to stringify player references."""
+
+    def __init__(self, directory, orb, sync_interval=SYNC_INTERVAL,
+                 snapshot_interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.orb = orb
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+
+        self.buffer = bytearray()   # Records not yet written
+        self.lock = threading.Lock()
+        self.file = None            # Current segment
+        self.segment = 0
+        self.incarnation = 0        # Highest incarnation seen
+        self.write_lock = threading.Lock()  # Held to write or rotate
+        self.collect = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    # Recording. These are called with the game's lock held, so the
+    # records of a game are in the same order as its changes.
+
+    def _append(self, data):
+        with self.lock:
+            self.buffer += data
+        RECORDS.inc()
+
+    def newGame(self, incarnation, name, created):
+        with self.lock:
+            self.incarnation = max(self.incarnation, incarnation)
+        self._append(_newRecord(incarnation, name, created))
+
+    def join(self, incarnation, ptype, player_name, player):
+        """Record a player joining, and return the stringified player
+        reference. player is None for a computer player."""
+        ior = "" if player is None else self.orb.object_to_string(player)
+        self._append(_joinRecord(incarnation, ptype, player_name, ior))
+        return ior
+
+    def move(self, incarnation, move):
+        self._append(_record(MOVE, MOVE_REC.pack(incarnation, move.seq,
+                                                 move.x, move.y,
+                                                 PLAYER_CODES[move.who])))
+
+    def endGame(self, incarnation):
+        self._append(_record(END, GAME_REC.pack(incarnation)))
+
+    # Recovery
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _segments(self):
+        ret = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX):
+                try:
+                    ret.append(int(name[len(SEGMENT_PREFIX):]))
+                except ValueError:
+                    pass
+        return sorted(ret)
+
+    def recover(self):
+        """Return the games in the journal, as a list of GameRecords in
+        creation order. Afterwards, incarnation is the highest
+        incarnation ever journalled, live or not."""
+        start = time.perf_counter()
+        games = {}
+        first = 0
+
+        try:
+            with open(self._path(SNAPSHOT_FILE), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+
+        for rtype, payload in _records(data):
+            if rtype == SEGMENT:
+                first = GAME_REC.unpack_from(payload)[0]
+                if len(payload) >= SEGMENT_REC.size:
+                    self.incarnation = max(self.incarnation,
+                                           SEGMENT_REC.unpack(payload)[1])
+            else:
+                self._apply(games, rtype, payload)
+
+        segments = [n for n in self._segments() if n >= first]
+        for n in segments:
+            with open(self._path(SEGMENT_PREFIX + str(n)), "rb") as f:
+                for rtype, payload in _records(f.read()):
+                    self._apply(games, rtype, payload)
+
+        self.segment = max(segments + [first])
+        log.info("Recovered %d games from the journal in %.3f s",
+                 len(games), time.perf_counter() - start)
+        return list(games.values())
+
+    def _apply(self, games, rtype, payload):
+        incarnation = GAME_REC.unpack_from(payload)[0]
+        self.incarnation = max(self.incarnation, incarnation)
+
+        if rtype == NEW:
+            if incarnation not in games:
+                inc, created = NEW_REC.unpack_from(payload)
+                name = payload[NEW_REC.size:].decode("utf-8")
+                games[incarnation] = GameRecord(incarnation, name, created)
+            return
+
+        if rtype == END:
+            games.pop(incarnation, None)
+            return
+
+        game = games.get(incarnation)
+        if game is None:
+            return
+
+        if rtype == JOIN:
+            inc, ptype, length = JOIN_REC.unpack_from(payload)
+            ptype = PLAYER_TYPES[ptype]
+            if ptype not in game.players:
+                end = JOIN_REC.size + length
+                game.player_names[ptype] = \
+                    payload[JOIN_REC.size:end].decode("utf-8")
+                game.players[ptype] = payload[end:].decode("ascii")
+
+        elif rtype == MOVE:
+            inc, seq, x, y, who = MOVE_REC.unpack(payload)
+            if seq != game.last_move.seq + 1:
+                return
+            who = PLAYER_TYPES[who]
+            if who == TicTacToe.Nought:
+                game.noughts |= 1 << (3 * x + y)
+            else:
+                game.crosses |= 1 << (3 * x + y)
+            game.last_move = TicTacToe.Move(seq, x, y, who)
+
+        elif rtype == STATE:
+            inc, noughts, crosses, seq, x, y, who = \
+                STATE_REC.unpack(payload)
+            if seq >= game.last_move.seq:
+                game.noughts = noughts
+                game.crosses = crosses
+                game.last_move = TicTacToe.Move(seq, x, y, PLAYER_TYPES[who])
+
+    # Writing
+
+    def start(self, collect):
+        """Start journalling. collect is a function returning the
+        GameRecords of the live games, for the snapshots. A snapshot is
+        taken straight away, so the recovered segments can go."""
+        self.collect = collect
+        self.snapshot()
+
+        threading.Thread(target=self._writer, name="JournalWriter",
+                         daemon=True).start()
+        threading.Thread(target=self._snapshotter, name="JournalSnapshot",
+                         daemon=True).start()
+
+    def _flush(self):
+        """Write and fsync the buffered records. Called with the write
+        lock held. Before the first segment is open, they are kept."""
+        if self.file is None:
+            return
+
+        with self.lock:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+
+        if data:
+            start = time.perf_counter()
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            FSYNCS.record(time.perf_counter() - start)
+
+    def _writer(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with self.write_lock:
+                    self._flush()
+            except OSError as ex:
+                log.error("Cannot write the journal: %s", ex)
+
+    def _snapshotter(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.snapshot()
+            except OSError as ex:
+                log.error("Cannot write a journal snapshot: %s", ex)
+
+    def snapshot(self):
+        """Start a new segment, write a snapshot of the live games, and
+        delete the segments it replaces."""
+        start = time.perf_counter()
+
+        with self.write_lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+            self.segment += 1
+            self.file = open(self._path(SEGMENT_PREFIX + str(self.segment)),
+                             "ab")
+            segment = self.segment
+
+        data = [_record(SEGMENT, SEGMENT_REC.pack(segment, self.incarnation))]
+        data.extend(gameRecords(game) for game in self.collect())
+
+        tmp = self._path(SNAPSHOT_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"".join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(SNAPSHOT_FILE))
+
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        for n in self._segments():
+            if n < segment:
+                os.remove(self._path(SEGMENT_PREFIX + str(n)))
+
+        SNAPSHOTS.record(time.perf_counter() - start)
+        log.debug("Journal snapshot of %d games", len(data) - 1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# gameLog.py
+#
+# Logging for the game server. Messages go to the "tictactoe" logger,
+# whose records are put on a queue and written out by a background
+# thread, so the threads serving requests and running notifiers never
+# wait for the terminal.
+#
+# The per-object and per-event messages are logged at DEBUG, so at the
+# default INFO level they cost no more than a level check. Messages
+# listed in SAMPLE_RATES are passed on only once in every so many
+# times, counted separately for each message, so turning on DEBUG does
+# not flood the output on a busy server.
+
+import atexit
+import itertools
+import logging
+import logging.handlers
+import sys
+from queue import SimpleQueue
+
+log = logging.getLogger("tictactoe")
+
+# Default level, which can be changed with the -logLevel option
+LOG_LEVEL = "INFO"
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+# Format string -> N, to log one in every N of those messages
+SAMPLE_RATES = {
+    "Notifying: %s": 100,
+    "GameIterator_i created.": 10,
+    "GameIterator_i deleted.": 10,
+}
+
+
+class SampleFilter(logging.Filter):
+    """Passes one in every N records with a given format string, as
+    set by sample(). Other records are all passed."""
+
+    def __init__(self):
+        super().__init__()
+        self.counters = {}  # Format string -> (N, itertools.count)
+
+    def sample(self, msg, every):
+        self.counters[msg] = (every, itertools.count())
+
+    def filter(self, record):
+        counter = self.counters.get(record.msg)
+        if counter is None:
+            return True
+        every, count = counter
+        return next(count) % every == 0
+
+
+sampler = SampleFilter()
+for msg, every in SAMPLE_RATES.items():
+    sampler.sample(msg, every)
+
+
+def sample(msg, every):
+    """Log only one in every N messages with format string msg."""
+    sampler.sample(msg, every)
+
+
+def start(level=LOG_LEVEL, stream=None):
+    """Send the log to stream, by default stdout, through a queue and a
+    background writer thread. level is a level name or number."""
+
+    queue = SimpleQueue()
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    listener = logging.handlers.QueueListener(queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+
+    log.addHandler(logging.handlers.QueueHandler(queue))
+    log.addFilter(sampler)
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+    log.propagate = False
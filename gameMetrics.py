@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# gameMetrics.py
+#
+# Runtime metrics for the game server: counters, latency histograms and
+# gauges, kept in a process-wide registry.
+#
+# Recording is meant to be left on. A counter increment or histogram
+# sample is a few integer operations under a lock that is never held
+# for anything else, and gauges cost nothing until a snapshot is taken,
+# since they are functions called only then. Histograms use power-of-two
+# buckets of microseconds, so percentiles are accurate to a factor of
+# two, which is plenty to spot a problem.
+
+import json
+import os
+import threading
+import time
+from functools import wraps
+from gameLog import log
+
+BUCKETS = 32  # Bucket i holds samples below 2**i microseconds
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+class Histogram:
+    """Latency samples, in seconds, counted in power-of-two buckets."""
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), BUCKETS - 1)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        """Return an upper bound for the p'th percentile, in seconds."""
+        with self.lock:
+            buckets = list(self.buckets)
+            count = self.count
+            maximum = self.max
+
+        wanted = p * count
+        seen = 0
+        for bucket, n in enumerate(buckets):
+            seen += n
+            if n and seen >= wanted:
+                return min((1 << bucket) / 1e6, maximum)
+        return maximum
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum,
+                "p50": self.percentile(0.5), "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99), "max": self.max}
+
+
+class Registry:
+    """Holds the metrics of a process, by name. Metrics are created on
+    first use, and are never removed."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def gauge(self, name, func):
+        """Register func, which takes no arguments and returns a number,
+        to be called for the value of the gauge when a snapshot is
+        taken."""
+        with self.lock:
+            self.gauges[name] = func
+
+    def snapshot(self):
+        """Return the current values of all the metrics, as a dict
+        that can be written out as JSON."""
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+            gauges = list(self.gauges.items())
+
+        values = {}
+        for name, func in gauges:
+            try:
+                values[name] = func()
+            except Exception:
+                values[name] = None
+
+        return {"time": time.time(),
+                "uptime": time.time() - self.started,
+                "counters": dict((n, c.value) for n, c in counters),
+                "gauges": values,
+                "histograms": dict((n, h.summary()) for n, h in histograms)}
+
+
+registry = Registry()
+
+
+def timed(name):
+    """Decorator counting the calls of a method, in a histogram of its
+    latency called name, and the calls that raise an exception, in a
+    counter called name + ".raised"."""
+
+    def decorate(method):
+        histogram = registry.histogram(name)
+        raised = registry.counter(name + ".raised")
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                raised.inc()
+                raise
+            finally:
+                histogram.record(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorate
+
+
+class TimedLock:
+    """A lock, used with the with statement, that records how long
+    threads waited for it in a histogram called name. Only contended
+    acquisitions are recorded, so the histogram's count is how often
+    the lock was found held, and an uncontended acquisition costs just
+    one extra method call."""
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.waits = registry.histogram(name)
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.waits.record(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class SnapshotWriter(threading.Thread):
+    """Writes a snapshot of the registry to a file as JSON every
+    interval seconds. The file is replaced atomically, so readers never
+    see a partial snapshot."""
+
+    def __init__(self, path, interval):
+        super().__init__(name="SnapshotWriter", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.start()
+
+    def run(self):
+        tmp = self.path + ".tmp"
+        while True:
+            time.sleep(self.interval)
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(registry.snapshot(), f, indent=2,
+                              sort_keys=True)
+                os.replace(tmp, self.path)
+            except OSError as ex:
+                log.warning("Cannot write metrics snapshot: %s", ex)
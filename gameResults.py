@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# gameResults.py
+#
+# Results of finished games, kept in memory for the Results interface,
+# and optionally appended to a file so they survive a restart.
+#
+# The results are stored by column, one array entry per game, oldest
+# first, with player names replaced by small integer ids, so a game
+# costs a few tens of bytes. The queries never scan the columns:
+#
+#  - recent results are the tails of the columns, or, for one player,
+#    of the list of rows that player took part in;
+#  - each player's win, loss and draw counts are kept up to date as
+#    results are added;
+#  - for the leaderboard, players are kept in buckets by number of
+#    wins, with a sorted list of the win counts in use, so the top N
+#    come from the highest buckets.
+#
+# Players are identified by the name they joined with; anonymous
+# players are recorded in the results, but not in the player indexes.
+
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+import heapq
+import TicTacToe
+
+from gameLog import log
+
+PLAYER_TYPES = (TicTacToe.Nobody, TicTacToe.Nought, TicTacToe.Cross)
+PLAYER_CODES = dict((p, i) for i, p in enumerate(PLAYER_TYPES))
+
+ANONYMOUS = 0  # Player id of players who did not give a name
+
+# File record: ended, winner, moves, then the game name and the names
+# of noughts and crosses, each as a length and UTF-8 bytes.
+RESULT = struct.Struct("<dBB")
+STRING = struct.Struct("<H")
+MAX_STRING = (1 << 16) - 1  # Longer names are cut short
+
+
+def _clip(s):
+    """Return s, cut short at a character boundary if its UTF-8 encoding
+    is longer than MAX_STRING bytes."""
+    data = s.encode("utf-8")
+    if len(data) <= MAX_STRING:
+        return s
+    return data[:MAX_STRING].decode("utf-8", "ignore")
+
+
+class ResultStore:
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+
+        # Columns
+        self.games = []           # Game names
+        self.noughts = array("I")  # Player ids
+        self.crosses = array("I")
+        self.winners = array("B")  # Index in PLAYER_TYPES
+        self.moves = array("B")
+        self.ended = array("d")    # Seconds since the epoch
+
+        # Players, by id
+        self.player_ids = {"": ANONYMOUS}
+        self.player_names = [""]
+        self.wins = array("I", [0])
+        self.losses = array("I", [0])
+        self.draws = array("I", [0])
+        self.player_rows = [None]  # Rows each player took part in
+
+        # Leaderboard: number of wins -> set of player ids, and the
+        # numbers of wins with a non-empty set, in ascending order
+        self.by_wins = {}
+        self.win_levels = []
+
+        self.file = None
+        if path:
+            self._load(path)
+            self.file = open(path, "ab")
+
+    def _playerId(self, name):
+        pid = self.player_ids.get(name)
+        if pid is None:
+            pid = len(self.player_names)
+            self.player_ids[name] = pid
+            self.player_names.append(name)
+            self.wins.append(0)
+            self.losses.append(0)
+            self.draws.append(0)
+            self.player_rows.append(array("I"))
+            self._setWins(pid, None, 0)
+        return pid
+
+    def _setWins(self, pid, old, new):
+        if old is not None:
+            bucket = self.by_wins[old]
+            bucket.discard(pid)
+            if not bucket:
+                del self.by_wins[old]
+                del self.win_levels[bisect_left(self.win_levels, old)]
+
+        bucket = self.by_wins.get(new)
+        if bucket is None:
+            bucket = self.by_wins[new] = set()
+            insort(self.win_levels, new)
+        bucket.add(pid)
+
+    def _add(self, game, noughts, crosses, winner, moves, ended):
+        """Add a result, with the lock held. winner is an index in
+        PLAYER_TYPES."""
+        row = len(self.games)
+        n = self._playerId(noughts)
+        c = self._playerId(crosses)
+
+        self.games.append(game)
+        self.noughts.append(n)
+        self.crosses.append(c)
+        self.winners.append(winner)
+        self.moves.append(moves)
+        self.ended.append(ended)
+
+        for pid, code in ((n, 1), (c, 2)):
+            if pid == ANONYMOUS:
+                continue
+            rows = self.player_rows[pid]
+            if not rows or rows[-1] != row:  # Unless playing themself
+                rows.append(row)
+            if winner == 0:
+                self.draws[pid] += 1
+            elif winner == code:
+                self.wins[pid] += 1
+                self._setWins(pid, self.wins[pid] - 1, self.wins[pid])
+            else:
+                self.losses[pid] += 1
+
+    def record(self, game, noughts, crosses, winner, moves):
+        """Record the result of a game. noughts and crosses are the
+        names of the players, winner a PlayerType."""
+        ended = time.time()
+        winner = PLAYER_CODES[winner]
+        game, noughts, crosses = [_clip(s) for s in (game, noughts, crosses)]
+
+        with self.lock:
+            self._add(game, noughts, crosses, winner, moves, ended)
+
+            if self.file is not None:
+                data = [RESULT.pack(ended, winner, moves)]
+                for s in (game, noughts, crosses):
+                    s = s.encode("utf-8")
+                    data.append(STRING.pack(len(s)) + s)
+                try:
+                    self.file.write(b"".join(data))
+                    self.file.flush()
+                except (OSError, ValueError) as ex:
+                    # ValueError if the file has been closed
+                    log.error("Cannot write results: %s", ex)
+
+    def _load(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        pos = good = 0
+        try:
+            while pos < len(data):
+                ended, winner, moves = RESULT.unpack_from(data, pos)
+                pos += RESULT.size
+                strings = []
+                for i in range(3):
+                    length = STRING.unpack_from(data, pos)[0]
+                    pos += STRING.size
+                    s = data[pos:pos + length]
+                    if len(s) != length:
+                        raise struct.error("short string")
+                    strings.append(s.decode("utf-8"))
+                    pos += length
+                self._add(strings[0], strings[1], strings[2], winner, moves,
+                          ended)
+                good = pos
+        except (struct.error, UnicodeDecodeError):
+            # Cut the damaged record off, so the results appended after
+            # it can be read back
+            log.warning("Results file %s ends with a damaged record; "
+                        "truncating it to %d bytes", path, good)
+            os.truncate(path, good)
+
+        log.info("Loaded %d results.", len(self.games))
+
+    # Queries
+
+    def _result(self, row):
+        return TicTacToe.GameResult(
+            self.games[row], self.player_names[self.noughts[row]],
+            self.player_names[self.crosses[row]],
+            PLAYER_TYPES[self.winners[row]], self.moves[row],
+            self.ended[row])
+
+    def recent(self, player, how_many):
+        """Return up to how_many GameResults, most recent first, of all
+        games, or of the named player's games. Returns None if there is
+        no such player."""
+        with self.lock:
+            if player:
+                pid = self.player_ids.get(player)
+                if pid is None:
+                    return None
+                rows = self.player_rows[pid]
+            else:
+                rows = range(len(self.games))
+
+            rows = rows[max(0, len(rows) - how_many):]
+            return [self._result(row) for row in reversed(rows)]
+
+    def _record(self, pid):
+        return TicTacToe.PlayerRecord(self.player_names[pid], self.wins[pid],
+                                      self.losses[pid], self.draws[pid])
+
+    def player(self, name):
+        """Return the PlayerRecord of the named player, or None."""
+        with self.lock:
+            pid = self.player_ids.get(name)
+            if not pid:
+                return None
+            return self._record(pid)
+
+    def leaderboard(self, how_many):
+        """Return the PlayerRecords of the how_many players with the
+        most wins, then the fewest losses, then by name."""
+        ret = []
+        with self.lock:
+            key = lambda pid: (self.losses[pid], self.player_names[pid])
+
+            for wins in reversed(self.win_levels):
+                wanted = how_many - len(ret)
+                if wanted <= 0:
+                    break
+                best = heapq.nsmallest(wanted, self.by_wins[wins], key=key)
+                ret.extend(self._record(pid) for pid in best)
+
+        return ret
@@ -1,30 +1,278 @@
+import heapq
+import itertools
+import os
+import random
 import sys
 import threading
 import time
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from queue import Queue
+import omniORB
 import CORBA
 import PortableServer
 import CosNaming
 import TicTacToe
 import TicTacToe__POA
-
-SCAVENGER_INTERVAL = 30
-
-class GameFactory_i(TicTacToe__POA.GameFactory):
-    def __init__(self, poa):
-        self.games = []
+import gameBot
+import gameJournal
+import gameLog
+import gameMetrics
+import gameResults
+from gameLog import log
+from gameMetrics import TimedLock, timed
+
+# Iterators that have not been used for this many seconds are
+# destroyed. Can be changed with the -iteratorTTL option.
+ITERATOR_TTL = 60
+
+# If true, callbacks to the players are queued on a per-player outbox
+# and delivered by the notifier pool, so GameController::play() returns
+# as soon as the move has been recorded. If false, the players are
+# called synchronously, before play() returns.
+ASYNC_PLAYER_CALLBACKS = True
+
+# Player callbacks. The outboxes are run by their own pool of
+# PLAYER_WORKERS threads, apart from spectator and lobby delivery, and
+# a player that takes longer than PLAYER_DEADLINE seconds to answer a
+# callback is treated as lost.
+PLAYER_WORKERS = 8
+PLAYER_DEADLINE = 5.0
+
+# If true, players and spectators are sent just the last move (the
+# yourGoMove, endMove and updateMove callbacks) rather than the whole
+# GameState after every move.
+DELTA_EVENTS = True
+
+# If true, all games and game controllers are incarnated in one shared
+# POA by a servant locator, using object ids derived from the game
+# names. If false, each game gets its own child POA.
+SINGLE_GAME_POA = True
+
+# Spectator notification. The event queues of all the games are run by
+# a pool of NOTIFIER_WORKERS threads, and each event is delivered to all
+# of a game's spectators concurrently by a pool of FANOUT_WORKERS
+# threads. A call that takes longer than SPECTATOR_DEADLINE seconds
+# counts as a timeout, and a spectator that times out
+# SPECTATOR_MAX_TIMEOUTS times in a row is dropped.
+NOTIFIER_WORKERS = 8
+FANOUT_WORKERS = 32
+SPECTATOR_DEADLINE = 2.0
+SPECTATOR_MAX_TIMEOUTS = 3
+
+# Lobby change feed. Each subscriber is sent up to LOBBY_BATCH changes
+# per call, with the same deadline as spectators. If a subscriber falls
+# LOBBY_MAX_BACKLOG changes behind, its backlog is discarded; it sees
+# the gap in the version numbers, and subscribes again.
+LOBBY_BATCH = 256
+LOBBY_MAX_BACKLOG = 4096
+
+# GameFactory::queryGames() finds finished games among the last
+# FINISHED_KEPT to end.
+FINISHED_KEPT = 1000
+
+# Games created by GameFactory::quickJoin() are named with this prefix
+# and a number.
+QUICK_GAME_PREFIX = "quick-"
+
+# Longest game or player name accepted, in bytes of UTF-8. The journal
+# and the results file store names with 16-bit lengths, in records of
+# at most 64 KiB.
+MAX_NAME_BYTES = 1024
+
+# The board is kept as one 9-bit mask per side, with square (x, y) at
+# bit 3 * x + y. These are the masks of the eight winning lines, and
+# for each square, the lines passing through it.
+WIN_MASKS = (
+    0x007, 0x038, 0x1c0,  # x = 0, 1, 2
+    0x049, 0x092, 0x124,  # y = 0, 1, 2
+    0x111, 0x054,         # diagonals
+)
+SQUARE_LINES = tuple(tuple(m for m in WIN_MASKS if m & (1 << sq))
+                     for sq in range(9))
+FULL_BOARD = 0x1ff
+
+NO_MOVE = TicTacToe.Move(0, 0, 0, TicTacToe.Nobody)
+
+# Object ids in the shared game POA are one of these prefixes, followed
+# by the game's incarnation number, "/", and the UTF-8 encoded game
+# name. The incarnation stops references to a finished game reaching a
+# later game with the same name.
+GAME_OID = b"G"
+CONTROLLER_OIDS = {TicTacToe.Nought: b"N", TicTacToe.Cross: b"X"}
+OID_PLAYER_TYPES = {v: k for k, v in CONTROLLER_OIDS.items()}
+
+# Metrics recorded outside the timed() servant methods, and how often
+# the metrics snapshot file is written, if there is one. The file is
+# named with the -statsFile option.
+metrics = gameMetrics.registry
+PLAYER_CALLBACKS     = metrics.histogram("Player.callback")
+PLAYERS_LOST         = metrics.counter("Player.lost")
+SPECTATOR_EVENTS     = metrics.histogram("Spectator.event")
+SPECTATOR_DELIVERIES = metrics.histogram("Spectator.delivery")
+SPECTATORS_TIMED_OUT = metrics.counter("Spectator.timedOut")
+SPECTATORS_LOST      = metrics.counter("Spectator.lost")
+SPECTATORS_DROPPED   = metrics.counter("Spectator.dropped")
+ITERATORS_EXPIRED    = metrics.counter("GameIterator.expired")
+GAMES_WON            = metrics.counter("Game.won")
+GAMES_DRAWN          = metrics.counter("Game.drawn")
+GAMES_KILLED         = metrics.counter("Game.killed")
+LOBBY_DELIVERIES     = metrics.histogram("Lobby.delivery")
+LOBBY_TIMED_OUT      = metrics.counter("Lobby.timedOut")
+LOBBY_LOST           = metrics.counter("Lobby.lost")
+LOBBY_OVERFLOWS      = metrics.counter("Lobby.overflowed")
+TIME_TO_MATCH        = metrics.histogram("QuickJoin.timeToMatch")
+STATS_INTERVAL = 10
+
+# Used to find the NameService if the ORB has no initial reference
+# for it, e.g. from -ORBInitRef NameService=corbaname::localhost
+NAMESERVICE_IOR = "IOR:010000002b00000049444c3a6f6d672e6f72672f436f734e616d696e672f4e616d696e67436f6e746578744578743a312e300000010000000000000070000000010102000e0000003139322e3136382e312e31303500f90a0b0000004e616d6553657276696365000300000000000000080000000100000000545441010000001c0000000100000001000100010000000100010509010100010000000901010003545441080000009c9b546701006a14"
+
+
+class IteratorRegistry:
+    """Keeps track of the GameIterators opened by a factory, in their
+    own POA, and destroys them when they have not been used for
+    iterator_ttl seconds."""
+
+    def _initIterators(self, poa, iterator_ttl):
+        # Open iterators, keyed by object id. They have their own lock,
+        # so expiring them never holds up the game registry.
         self.iterators = {}
-        self.lock = threading.Lock()
-        self.poa = poa
+        self.iterator_lock = threading.Lock()
+        self.iterator_ttl = iterator_ttl
+        metrics.gauge("GameIterator.open", lambda: len(self.iterators))
 
         self.iterator_poa = poa.create_POA("IterPOA", None, [])
         self.iterator_poa._get_the_POAManager().activate()
 
         self.iterator_scavenger = IteratorScavenger(self)
 
-        print("GameFactory_i created.")
+    def _activateIterator(self, iter):
+        iid = self.iterator_poa.activate_object(iter)
+        iobj = self.iterator_poa.id_to_reference(iid)
+        with self.iterator_lock:
+            self.iterators[iid] = iter
+        self.iterator_scavenger.add(iid, iter.deadline)
+        return iobj
+
+    def _removeIterator(self, iid):
+        """Forget an iterator. Returns False if it had already gone."""
+        with self.iterator_lock:
+            return self.iterators.pop(iid, None) is not None
+
+    def _expireIterator(self, iid, now):
+        """Destroy an iterator if its deadline has passed. Returns None
+        if it has, or has already gone, otherwise its new deadline."""
+        with self.iterator_lock:
+            iter = self.iterators.get(iid)
+            if iter is None:
+                return None
+            if iter.deadline > now:
+                return iter.deadline
+            del self.iterators[iid]
+
+        ITERATORS_EXPIRED.inc()
+
+        self.iterator_poa.deactivate_object(iid)
+        return None
 
+
+class GameFactory_i(IteratorRegistry, TicTacToe__POA.GameFactory):
+    def __init__(self, poa, iterator_ttl=ITERATOR_TTL, journal=None,
+                 results=None):
+        # Registry of active games, keyed by name. Dicts keep insertion
+        # order, so iterating over it lists games in creation order.
+        self.games = {}
+
+        # Listings page over an immutable snapshot of the registry. The
+        # snapshot is rebuilt lazily when the generation has moved on,
+        # so all listings taken between changes share the same tuple.
+        self.generation = 0
+        self.snapshot = ()
+        self.snapshot_generation = 0
+        self.lock = TimedLock("GameFactory.lockWait")
+        self.poa = poa
+        self.journal = journal
+        self.results = results or gameResults.ResultStore()
+
+        self._initIterators(poa, iterator_ttl)
+
+        if SINGLE_GAME_POA:
+            ps = [poa.create_id_assignment_policy(PortableServer.USER_ID),
+                  poa.create_servant_retention_policy(
+                      PortableServer.NON_RETAIN),
+                  poa.create_request_processing_policy(
+                      PortableServer.USE_SERVANT_MANAGER)]
+
+            # Games recovered from the journal keep their object ids,
+            # so references to them survive a restart.
+            if journal is not None:
+                ps.append(poa.create_lifespan_policy(
+                    PortableServer.PERSISTENT))
+
+            self.game_poa = poa.create_POA("GamePOA", None, ps)
+            self.game_poa.set_servant_manager(GameLocator(self))
+            self.game_poa._get_the_POAManager().activate()
+        else:
+            self.game_poa = None
+
+        self.scheduler = NotificationScheduler()
+        self.player_scheduler = NotificationScheduler(PLAYER_WORKERS,
+                                                      "PlayerNotifier")
+        self.fanout = SpectatorFanOut()
+
+        # Changes to the registry and to the games' numbers of players
+        # are published to the lobby with the factory's lock or the
+        # game's held, so they are in order, and a subscription's
+        # snapshot, taken with the factory's lock held, fits in.
+        self.lobby = Lobby(self.scheduler)
+
+        # Indexes for queryGames(), updated at the same points
+        self.index = GameIndex()
+
+        self.matchmaker = MatchMaker(self)
+
+        metrics.gauge("Game.live", lambda: len(self.games))
+        metrics.gauge("Spectator.live", lambda: sum(
+            len(g[1].spectators) for g in self._snapshot()))
+        metrics.gauge("Notifier.ready", self.scheduler.ready.qsize)
+        metrics.gauge("PlayerNotifier.ready",
+                      self.player_scheduler.ready.qsize)
+        metrics.gauge("Notifier.queued", lambda: sum(
+            g[1].spectatorNotifier.depth() +
+            sum(o.depth() for o in list(g[1].outboxes.values()))
+            for g in self._snapshot()))
+        metrics.gauge("Spectator.pending", lambda: len(self.fanout.pending))
+
+        log.info("GameFactory_i created.")
+
+    @timed("GameFactory.newGame")
     def newGame(self, name):
+        checkName(name)
+        if SINGLE_GAME_POA:
+            with self.lock:
+                if name in self.games:
+                    raise TicTacToe.GameFactory.NameInUse()
+
+                self.generation += 1
+                gservant = Game_i(self, name, None)
+                gservant.incarnation = self.generation
+                gobj = self._reference(GAME_OID, gservant, TicTacToe.Game)
+                self.games[name] = (name, gservant, gobj)
+                self.lobby.publish(TicTacToe.GameAdded, name, gobj, 0)
+                self.index.add(name, gobj, 0)
+
+                if self.journal is not None:
+                    self.journal.newGame(gservant.incarnation, name,
+                                         gservant.created)
+
+            return gobj
+
+        with self.lock:
+            if name in self.games:
+                raise TicTacToe.GameFactory.NameInUse()
+
         try:
             game_poa = self.poa.create_POA("Game-" + name, None, [])
 
@@ -37,93 +285,264 @@ class GameFactory_i(TicTacToe__POA.GameFactory):
         game_poa._get_the_POAManager().activate()
 
         with self.lock:
-            self.games.append((name, gservant, gobj))
+            self.games[name] = (name, gservant, gobj)
+            self.generation += 1
+            self.lobby.publish(TicTacToe.GameAdded, name, gobj, 0)
+            self.index.add(name, gobj, 0)
 
         return gobj
 
-    def listGames(self, how_many):
+    @timed("GameFactory.findGame")
+    def findGame(self, name):
         with self.lock:
-            front = self.games[:int(how_many)]
-            rest = self.games[int(how_many):]
+            game = self.games.get(name)
 
-        ret = list(map(lambda g: TicTacToe.GameInfo(g[0], g[2]), front))
+        if game is None:
+            raise TicTacToe.GameFactory.NotFound()
 
-        if rest:
-            iter = GameIterator_i(self, self.iterator_poa, rest)
-            iid = self.iterator_poa.activate_object(iter)
-            iobj = self.iterator_poa.id_to_reference(iid)
-            with self.lock:
-                self.iterators[iid] = iter
+        return game[2]
+
+    @timed("GameFactory.listGames")
+    def listGames(self, how_many):
+        how_many = int(how_many)
+        games = self._snapshot()
+
+        ret = [g[1]._summary(g[2]) for g in games[:how_many]]
+
+        if len(games) > how_many:
+            iter = GameIterator_i(self, self.iterator_poa, games, how_many)
+            iobj = self._activateIterator(iter)
         else:
             iobj = None
 
         return ret, iobj
 
-    def _removeGame(self, name):
+    @timed("GameFactory.describeGames")
+    def describeGames(self, names):
+        ret = []
+        for name in names:
+            # A single dict lookup is atomic, so the lock is not needed
+            game = self.games.get(name)
+            if game is not None:
+                ret.append(game[1]._summary(game[2]))
+        return ret
+
+    @timed("GameFactory.queryGames")
+    def queryGames(self, statuses, prefix, start_after, how_many):
+        return self.index.query(statuses or STATUSES, prefix, start_after,
+                                int(how_many))
+
+    @timed("GameFactory.quickJoin")
+    def quickJoin(self, player, player_name):
+        checkName(player_name)
+        return self.matchmaker.quickJoin(player, player_name)
+
+    @timed("GameFactory.subscribeLobby")
+    def subscribeLobby(self, listener):
+        with self.lock:
+            return self.lobby.subscribe(listener, self._lobbyGames)
+
+    def unsubscribeLobby(self, cookie):
+        self.lobby.unsubscribe(int(cookie))
+
+    def _lobbyGames(self):
+        """Return the lobby entries of the active games. Called with
+        the lock held."""
+        return [TicTacToe.LobbyGame(TicTacToe.GameInfo(g[0], g[2]),
+                                    g[1].players)
+                for g in self.games.values()]
+
+    def _reference(self, prefix, gservant, interface):
+        """Create a reference to an object in the shared game POA."""
+        oid = b"%s%d/%s" % (prefix, gservant.incarnation,
+                            gservant.name.encode("utf-8"))
+        return self.game_poa.create_reference_with_id(oid, CORBA.id(interface))
+
+    def _locate(self, oid):
+        """Find the servant for an object id in the shared game POA,
+        or None if the game has gone."""
+        prefix = oid[:1]
+        incarnation, _, name = oid[1:].partition(b"/")
+
+        # A single dict lookup is atomic, so the lock is not needed
+        game = self.games.get(name.decode("utf-8"))
+        if game is None or game[1].incarnation != int(incarnation):
+            return None
+
+        gservant = game[1]
+        if prefix == GAME_OID:
+            return gservant
+
+        ptype = OID_PLAYER_TYPES.get(prefix)
+        if ptype is None:
+            return None
+
+        return gservant.controllers.get(ptype)
+
+    def _snapshot(self):
+        """Return a tuple of the active games, shared between all the
+        listings taken at the same registry generation."""
         with self.lock:
-            self.games = [game for game in self.games if game[0] != name]
+            if self.snapshot_generation != self.generation:
+                self.snapshot = tuple(self.games.values())
+                self.snapshot_generation = self.generation
+            return self.snapshot
 
-    def _removeIterator(self, iid):
+    def _removeGame(self, name):
         with self.lock:
-            del self.iterators[iid]
+            game = self.games.pop(name, None)
+            if game is None:
+                return
+            self.generation += 1
+            self.lobby.publish(TicTacToe.GameRemoved, name, None, 0)
+            self.index.finish(name)
+
+        # Only journalled once the game is out of the registry, so a
+        # journal snapshot cannot bring it back
+        if self.journal is not None:
+            self.journal.endGame(game[1].incarnation)
+
+    def _gameRecords(self):
+        """Return the journal records of the live games, for a journal
+        snapshot."""
+        return [g[1]._journalRecord() for g in self._snapshot()]
+
+    def _recover(self, records):
+        """Recreate the games recovered from the journal, with their old
+        incarnation numbers, so that existing references to them and
+        their controllers reach them again. Games that were over are
+        dropped."""
+
+        restored = []
+        with self.lock:
+            # Not only the live games: references to ended games must
+            # not reach new games that reuse their incarnations
+            self.generation = max(self.generation, self.journal.incarnation)
+
+            for record in records:
+                self.generation = max(self.generation, record.incarnation)
+
+                over = record.noughts | record.crosses == FULL_BOARD
+                for mask in (record.noughts, record.crosses):
+                    over = over or any(mask & m == m for m in WIN_MASKS)
+                if over or record.name in self.games:
+                    continue
+
+                gservant = Game_i(self, record.name, None)
+                gservant.incarnation = record.incarnation
+                try:
+                    gservant._restore(record, self.journal.orb)
+                except CORBA.SystemException as ex:
+                    log.warning("%s: cannot restore players: %s",
+                                record.name, CORBA.id(ex))
+                    continue
+
+                gobj = self._reference(GAME_OID, gservant, TicTacToe.Game)
+                self.games[record.name] = (record.name, gservant, gobj)
+                self.lobby.publish(TicTacToe.GameAdded, record.name, gobj,
+                                   gservant.players)
+                self.index.add(record.name, gobj, gservant.players)
+                restored.append(gservant)
+
+            self.generation += 1
+
+        log.info("Restored %d games.", len(restored))
+        for gservant in restored:
+            gservant._resume()
+
+
+class GameLocator(PortableServer.ServantLocator):
+    """Incarnates the games and game controllers in the shared game
+    POA, by looking up the game named in the object id."""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def preinvoke(self, oid, poa, operation):
+        servant = self.factory._locate(oid)
+        if servant is None:
+            raise CORBA.OBJECT_NOT_EXIST(0, CORBA.COMPLETED_NO)
+        return servant, None
+
+    def postinvoke(self, oid, poa, operation, cookie, servant):
+        pass
 
 
 class GameIterator_i(TicTacToe__POA.GameIterator):
-    def __init__(self, factory, poa, games):
+    def __init__(self, factory, poa, games, pos):
+        # games is a registry snapshot shared with other iterators, so
+        # it is never modified; the iterator only moves its cursor. The
+        # summaries are of the games' status when each page is taken.
         self.factory = factory
         self.poa = poa
         self.games = games
-        self.tick = 1
-        print("GameIterator_i created.")
+        self.pos = pos
+        self.deadline = time.monotonic() + factory.iterator_ttl
+        log.debug("GameIterator_i created.")
 
     def __del__(self):
-        print("GameIterator_i deleted.")
+        log.debug("GameIterator_i deleted.")
 
+    @timed("GameIterator.next_n")
     def next_n(self, how_many):
-        self.tick = 1
-        front = self.games[:int(how_many)]
-        self.games = self.games[int(how_many):]
+        self.deadline = time.monotonic() + self.factory.iterator_ttl
+        end = self.pos + int(how_many)
+        front = self.games[self.pos:end]
+        self.pos = min(end, len(self.games))
 
-        ret = list(map(lambda g: TicTacToe.GameInfo(g[0], g[2]), front))
+        ret = [g[1]._summary(g[2]) for g in front]
 
-        more = bool(self.games)
+        more = self.pos < len(self.games)
         return ret, more
 
     def destroy(self):
         id = self.poa.servant_to_id(self)
-        self.factory._removeIterator(id)
-        self.poa.deactivate_object(id)
+        if self.factory._removeIterator(id):
+            self.poa.deactivate_object(id)
 
 
 class IteratorScavenger(threading.Thread):
+
+    # Iterators are kept in a heap ordered by deadline, and the thread
+    # sleeps until the earliest one. Using an iterator just moves its
+    # deadline on, without touching the heap; when the stale entry
+    # reaches the top, it is pushed back with the new deadline. Each
+    # expiry only holds the factory's iterator lock for a moment, and
+    # the iterator POA keeps serving requests throughout.
+
     def __init__(self, factory):
         super().__init__()
         self.setDaemon(True)
         self.factory = factory
+        self.heap = []
+        self.cond = threading.Condition()
         self.start()
 
-    def run(self):
-        print("Iterator scavenger running...")
+    def add(self, iid, deadline):
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, iid))
+            if self.heap[0][1] is iid:
+                self.cond.notify()
 
-        lock = self.factory.lock
-        iterators = self.factory.iterators
-        poa = self.factory.iterator_poa
-        manager = poa._get_the_POAManager()
+    def run(self):
+        log.info("Iterator scavenger running...")
 
         while True:
-            time.sleep(SCAVENGER_INTERVAL)
-            print("Scavenging dead iterators...")
-
-            manager.hold_requests(True)
-            with lock:
-                for id, iter in list(iterators.items()):
-                    if iter.tick == 1:
-                        iter.tick = 0
-                    else:
-                        del iterators[id]
-                        poa.deactivate_object(id)
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+
+                deadline, iid = self.heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self.cond.wait(deadline - now)
+                    continue
 
-            manager.activate()
+                heapq.heappop(self.heap)
+
+            deadline = self.factory._expireIterator(iid, now)
+            if deadline is not None:
+                self.add(iid, deadline)
 
 
 class Game_i(TicTacToe__POA.Game):
@@ -131,298 +550,1288 @@ class Game_i(TicTacToe__POA.Game):
         self.factory = factory
         self.name = name
         self.poa = poa
-        self.lock = threading.Lock()
+        self.lock = TimedLock("Game.lockWait")
+        self.incarnation = 0  # Set by the factory in the shared game POA
+        self.created = time.time()
 
-        n = TicTacToe.Nobody
         self.players = 0
-        self.state = [[n, n, n], [n, n, n], [n, n, n]]
+        self.noughts = 0  # Bit masks of the squares held by each side
+        self.crosses = 0
+        self.state_cache = None
+        self.last_move = NO_MOVE
 
         self.p_noughts = None
         self.p_crosses = None
+        self.outboxes = {}  # PlayerType -> PlayerOutbox
+        self.player_iors = {}  # PlayerType -> IOR, if journalling
+        self.player_names = {}  # PlayerType -> name, "" if anonymous
+        self.controllers = {}  # PlayerType -> GameController_i
         self.whose_go = TicTacToe.Nobody
-        self.spectators = []
-        self.spectatorNotifier = SpectatorNotifier(self.spectators, self.lock)
+        self.finished = False
+        self.spectators = SpectatorTable()
+        self.spectatorNotifier = SpectatorNotifier(factory.scheduler,
+                                                   self.spectators, self.lock,
+                                                   factory.fanout)
 
-        print("Game_i created.")
+        log.debug("Game_i created.")
 
+    @timed("Game.joinGame")
     def joinGame(self, player):
+        return self._join(player)
+
+    @timed("Game.joinGameAs")
+    def joinGameAs(self, player, player_name):
+        return self._join(player, player_name)
+
+    @timed("Game.addComputerPlayer")
+    def addComputerPlayer(self):
+        self._join(gameBot.ComputerPlayer(self), gameBot.NAME)
+
+    def _join(self, player, player_name=""):
+        """Add player to the game. A ComputerPlayer needs no controller,
+        and is always called through an outbox, so that its moves are
+        not made inside the opponent's play() call."""
+
+        computer = isinstance(player, gameBot.ComputerPlayer)
+        checkName(player_name)
+
         with self.lock:
-            if self.players == 2:
+            if self.players == 2 or self.finished:
                 raise TicTacToe.Game.CannotJoin()
 
             if self.players == 0:
                 ptype = TicTacToe.Nought
-                self.p_noughts = player
             else:
                 ptype = TicTacToe.Cross
-                self.p_crosses = player
-                self.whose_go = TicTacToe.Nought
-                self.p_noughts.yourGo(self.state)
 
-            gc = GameController_i(self, ptype)
-            id = self.poa.activate_object(gc)
-            gobj = self.poa.id_to_reference(id)
-            self.players += 1
+            gobj = self._addPlayer(ptype, player, computer)
+            self.player_names[ptype] = player_name
+            self.factory.lobby.publish(TicTacToe.PlayersChanged, self.name,
+                                       None, self.players)
+            self.factory.index.setPlayers(self.name, self.players)
+
+            journal = self.factory.journal
+            if journal is not None:
+                self.player_iors[ptype] = journal.join(
+                    self.incarnation, ptype, player_name,
+                    None if computer else player)
+
+        # Tell noughts it's their go, without holding the lock
+        if ptype == TicTacToe.Cross:
+            try:
+                if DELTA_EVENTS:
+                    self._tellPlayer(TicTacToe.Nought, "yourGoMove", NO_MOVE)
+                else:
+                    with self.lock:
+                        state = self._getState()
+                    self._tellPlayer(TicTacToe.Nought, "yourGo", state)
+            except (CORBA.COMM_FAILURE, CORBA.TRANSIENT,
+                    CORBA.OBJECT_NOT_EXIST) as ex:
+                log.warning("%s: lost contact with player", self.name)
+                PLAYERS_LOST.inc()
+                self.kill()
 
         return gobj, ptype
 
+    def _addPlayer(self, ptype, player, computer):
+        """Install player as ptype, with the lock held. Returns the
+        reference of its GameController, or None for a computer
+        player."""
+
+        if ptype == TicTacToe.Nought:
+            self.p_noughts = player
+        else:
+            self.p_crosses = player
+            self.whose_go = TicTacToe.Nought
+
+        if ASYNC_PLAYER_CALLBACKS or computer:
+            self.outboxes[ptype] = PlayerOutbox(
+                self.factory.player_scheduler, self, player)
+
+        self.players += 1
+        if computer:
+            player.ptype = ptype
+            return None
+
+        # Bound every callback, so a hung client is treated as lost
+        # rather than holding a worker, or play(), indefinitely.
+        omniORB.setClientCallTimeout(player, int(PLAYER_DEADLINE * 1000))
+
+        gc = GameController_i(self, ptype)
+        return self._activateController(gc, ptype)
+
+    def _restore(self, record, orb):
+        """Set the game up from a journal GameRecord, before it is
+        registered with the factory."""
+
+        self.noughts = record.noughts
+        self.crosses = record.crosses
+        self.last_move = record.last_move
+        self.created = record.created
+
+        for ptype in (TicTacToe.Nought, TicTacToe.Cross):
+            ior = record.players.get(ptype)
+            if ior is None:
+                continue
+
+            if ior:
+                player = orb.string_to_object(ior)._narrow(TicTacToe.Player)
+                self._addPlayer(ptype, player, False)
+            else:
+                self._addPlayer(ptype, gameBot.ComputerPlayer(self), True)
+            self.player_iors[ptype] = ior
+            self.player_names[ptype] = record.player_names.get(ptype, "")
+
+        if self.players == 2:
+            if self.last_move.seq % 2 == 0:
+                self.whose_go = TicTacToe.Nought
+            else:
+                self.whose_go = TicTacToe.Cross
+
+    def _resume(self):
+        """Remind the player whose go it is, after a restart. They may
+        never have been told, if the server stopped first."""
+
+        if self.whose_go == TicTacToe.Nobody:
+            return
+
+        try:
+            if DELTA_EVENTS:
+                self._tellPlayer(self.whose_go, "yourGoMove", self.last_move)
+            else:
+                with self.lock:
+                    state = self._getState()
+                self._tellPlayer(self.whose_go, "yourGo", state)
+        except (CORBA.COMM_FAILURE, CORBA.TRANSIENT,
+                CORBA.OBJECT_NOT_EXIST) as ex:
+            log.warning("%s: lost contact with player", self.name)
+            PLAYERS_LOST.inc()
+            self.kill()
+
+    def _summary(self, gobj):
+        """Return a GameSummary of the game, whose reference is gobj.
+        The fields are read without the lock, since each is only ever
+        replaced whole, and a listing is out of date as soon as it is
+        sent anyway."""
+        return TicTacToe.GameSummary(self.name, gobj, self.players,
+                                     self.whose_go, self.last_move.seq,
+                                     len(self.spectators), self.created)
+
+    def _journalRecord(self):
+        """Return the state of the game as a journal GameRecord."""
+        with self.lock:
+            record = gameJournal.GameRecord(self.incarnation, self.name,
+                                            self.created)
+            record.players = dict(self.player_iors)
+            record.player_names = dict(self.player_names)
+            record.noughts = self.noughts
+            record.crosses = self.crosses
+            record.last_move = self.last_move
+        return record
+
+    @timed("Game.watchGame")
     def watchGame(self, spectator):
-        self.lock.acquire()
-        cookie = len(self.spectators)
-        self.spectators.append(spectator)
-        self.lock.release()
-        return cookie, self.state
+        # Bound every call to the spectator, so a dead client cannot
+        # hold a fan-out worker for longer than the delivery deadline.
+        omniORB.setClientCallTimeout(spectator,
+                                     int(SPECTATOR_DEADLINE * 1000))
+        with self.lock:
+            cookie = self.spectators.add(DeliveryStats(spectator))
+            return cookie, self._getState()
 
+    @timed("Game.unwatchGame")
     def unwatchGame(self, cookie):
-        cookie = int(cookie)
-        self.lock.acquire()
-        if len(self.spectators) > cookie:
-            self.spectators[cookie] = None
-        self.lock.release()
+        with self.lock:
+            self.spectators.remove(int(cookie))
 
-    def kill(self):
-        self.factory._removeGame(self.name)
+    def _get_name(self):
+        return self.name
 
-        if self.p_noughts:
-            try:
-                self.p_noughts.gameAborted()
-            except CORBA.SystemException as ex:
-                print("System exception contacting noughts player")
+    def _get_players(self):
+        return self.players
 
-        if self.p_crosses:
-            try:
-                self.p_crosses.gameAborted()
-            except CORBA.SystemException as ex:
-                print("System exception contacting crosses player")
+    def _get_state(self):
+        with self.lock:
+            return self._getState()
+
+    @timed("Game.resync")
+    def resync(self):
+        with self.lock:
+            return self._getState(), self.last_move.seq
+
+    @timed("Game.kill")
+    def kill(self):
+        if not self._finish():
+            return
+
+        GAMES_KILLED.inc()
+
+        for ptype, player, desc in ((TicTacToe.Nought, self.p_noughts,
+                                     "noughts"),
+                                    (TicTacToe.Cross, self.p_crosses,
+                                     "crosses")):
+            if player:
+                try:
+                    self._tellPlayer(ptype, "gameAborted")
+                except CORBA.SystemException as ex:
+                    log.warning("%s: system exception contacting %s player",
+                                self.name, desc)
 
         self.spectatorNotifier.gameAborted()
+        self._teardown()
 
-        self.poa.destroy(1, 0)
+        log.info("%s: game killed", self.name)
 
-        print("Game killed")
+    def _finish(self):
+        """Mark the game as over. Returns False if it already was."""
+        with self.lock:
+            if self.finished:
+                return False
+            self.finished = True
+            return True
+
+    def _teardown(self):
+        self.factory._removeGame(self.name)
+        self.spectatorNotifier.close()
+        for outbox in self.outboxes.values():
+            outbox.close()
+
+        # In the shared game POA, the locator stops finding the game and
+        # its controllers as soon as it is out of the factory registry.
+        if self.poa is not None:
+            self.poa.destroy(1, 0)
+
+    def _activateController(self, gc, ptype):
+        if self.poa is None:
+            self.controllers[ptype] = gc
+            return self.factory._reference(CONTROLLER_OIDS[ptype], self,
+                                           TicTacToe.GameController)
+
+        id = self.poa.activate_object(gc)
+        return self.poa.id_to_reference(id)
+
+    def _tellPlayer(self, ptype, method, *args):
+        """Call method(*args) on the player of type ptype, either by
+        queueing it on the player's outbox, or synchronously, in which
+        case CORBA exceptions propagate to the caller."""
+
+        outbox = self.outboxes.get(ptype)
+        if outbox is not None:
+            outbox.post((method, args))
+        elif ptype == TicTacToe.Nought:
+            getattr(self.p_noughts, method)(*args)
+        else:
+            getattr(self.p_crosses, method)(*args)
 
     def _play(self, x, y, ptype):
+        """Real implementation of GameController::play()"""
         x = int(x)
         y = int(y)
-        """Real implementation of GameController::play()"""
-        if self.whose_go != ptype:
-            raise TicTacToe.GameController.NotYourGo()
 
-        if x < 0 or x > 2 or y < 0 or y > 2:
-            raise TicTacToe.GameController.InvalidCoordinates()
+        with self.lock:
+            if self.whose_go != ptype:
+                raise TicTacToe.GameController.NotYourGo()
 
-        if self.state[x][y] != TicTacToe.Nobody:
-            raise TicTacToe.GameController.SquareOccupied()
+            if x < 0 or x > 2 or y < 0 or y > 2:
+                raise TicTacToe.GameController.InvalidCoordinates()
 
-        self.state[x][y] = ptype
+            square = 3 * x + y
+            bit = 1 << square
+            if (self.noughts | self.crosses) & bit:
+                raise TicTacToe.GameController.SquareOccupied()
 
-        w = self._checkForWinner()
+            if ptype == TicTacToe.Nought:
+                self.noughts |= bit
+                mask = self.noughts
+                opponent = TicTacToe.Cross
+            else:
+                self.crosses |= bit
+                mask = self.crosses
+                opponent = TicTacToe.Nought
 
-        try:
-            if w is not None:
-                print("Winner:", w)
-                self.p_noughts.end(self.state, w)
-                self.p_crosses.end(self.state, w)
-                self.spectatorNotifier.end(self.state, w)
-
-                # Kill ourselves
-                self.factory._removeGame(self.name)
-                self.poa.destroy(1, 0)
+            self.state_cache = None
+            move = self.last_move = TicTacToe.Move(self.last_move.seq + 1,
+                                                   x, y, ptype)
+
+            journal = self.factory.journal
+            if journal is not None:
+                journal.move(self.incarnation, move)
+
+            w = self._checkForWinner(square, mask, ptype)
+            if w is None:
+                self.whose_go = opponent
             else:
+                self.whose_go = TicTacToe.Nobody
 
-                # Tell opponent it's their go
-                if ptype == TicTacToe.Nought:
-                    self.whose_go = TicTacToe.Cross
-                    self.p_crosses.yourGo(self.state)
-                else:
-                    self.whose_go = TicTacToe.Nought
-                    self.p_noughts.yourGo(self.state)
+            state = self._getState()
 
-                s = (self.state[0][:], self.state[1][:], self.state[2][:])
-                self.spectatorNotifier.queue.put(("update", (s,)))
+        if w is not None:
+            if not self._finish():
+                return state
 
-                # self.spectatorNotifier.up(self.state)
+            log.info("%s: winner %s", self.name, w)
+            if w == TicTacToe.Nobody:
+                GAMES_DRAWN.inc()
+            else:
+                GAMES_WON.inc()
 
-        except (CORBA.COMM_FAILURE, CORBA.OBJECT_NOT_EXIST) as ex:
-            print("Lost contact with player!")
+            for p in (TicTacToe.Nought, TicTacToe.Cross):
+                try:
+                    if DELTA_EVENTS:
+                        self._tellPlayer(p, "endMove", move, w)
+                    else:
+                        self._tellPlayer(p, "end", state, w)
+                except (CORBA.COMM_FAILURE, CORBA.TRANSIENT,
+                        CORBA.OBJECT_NOT_EXIST) as ex:
+                    log.warning("%s: lost contact with player", self.name)
+                    PLAYERS_LOST.inc()
+
+            if DELTA_EVENTS:
+                self.spectatorNotifier.endMove(move, w)
+            else:
+                self.spectatorNotifier.end(state, w)
+
+            # Kill ourselves
+            self._teardown()
+
+            # Last, so that a failure cannot stop the game ending
+            try:
+                self.factory.results.record(
+                    self.name, self.player_names.get(TicTacToe.Nought, ""),
+                    self.player_names.get(TicTacToe.Cross, ""), w, move.seq)
+            except Exception:
+                log.exception("%s: cannot record the result", self.name)
+
+            return state
+
+        try:
+            # Tell opponent it's their go
+            if DELTA_EVENTS:
+                self._tellPlayer(opponent, "yourGoMove", move)
+                self.spectatorNotifier.updateMove(move)
+            else:
+                self._tellPlayer(opponent, "yourGo", state)
+                self.spectatorNotifier.up(state)
+
+        except (CORBA.COMM_FAILURE, CORBA.TRANSIENT,
+                CORBA.OBJECT_NOT_EXIST) as ex:
+            log.warning("%s: lost contact with player", self.name)
+            PLAYERS_LOST.inc()
             self.kill()
 
-        return self.state
-
-    def _checkForWinner(self):
-        """If there is a winner, return the winning player's type. If
-        the game is a tie, return Nobody, otherwise return None."""
-
-        # Rows
-        for i in range(3):
-            if self.state[i][0] == self.state[i][1] and \
-                    self.state[i][1] == self.state[i][2] and \
-                    self.state[i][0] != TicTacToe.Nobody:
-                return self.state[i][0]
-
-        # Columns
-        for i in range(3):
-            if self.state[0][i] == self.state[1][i] and \
-                    self.state[1][i] == self.state[2][i] and \
-                    self.state[0][i] != TicTacToe.Nobody:
-                return self.state[0][i]
-
-        # Top-left to bottom-right
-        if self.state[0][0] == self.state[1][1] and \
-                self.state[1][1] == self.state[2][2] and \
-                self.state[0][0] != TicTacToe.Nobody:
-            return self.state[0][0]
-
-        # Bottom-left to top-right
-        if self.state[0][2] == self.state[1][1] and \
-                self.state[1][1] == self.state[2][0] and \
-                self.state[0][2] != TicTacToe.Nobody:
-            return self.state[0][2]
-
-        # Return None if the game is not full
-        for i in range(3):
-            for j in range(3):
-                if self.state[i][j] == TicTacToe.Nobody:
-                    return None
-
-        # It's a draw
-        return TicTacToe.Nobody
-
-class SpectatorNotifier(threading.Thread):
-
-    # This thread is used to notify all the spectators about changes
-    # in the game state. Since there is only one thread, one errant
-    # spectator can hold up all the others. A proper event or
-    # notification service should make more effort to contact clients
-    # concurrently. No matter what happens, the players can't be held
-    # up.
+        return state
+
+    def _checkForWinner(self, square, mask, ptype):
+        """Called after ptype, holding the squares in mask, has played
+        square. If there is a winner, return the winning player's
+        type. If the game is a tie, return Nobody, otherwise return
+        None."""
+
+        # Only lines through the square just played can have been won
+        for line in SQUARE_LINES[square]:
+            if mask & line == line:
+                return ptype
+
+        if self.noughts | self.crosses == FULL_BOARD:
+            # It's a draw
+            return TicTacToe.Nobody
+
+        return None
+
+    def _getState(self):
+        """Return the board as an IDL GameState, with the lock held.
+        The matrix is built from the bit masks at most once per move,
+        and is never modified afterwards, so it can be shared with the
+        notifiers."""
+
+        state = self.state_cache
+        if state is None:
+            state = []
+            for x in range(3):
+                row = []
+                for y in range(3):
+                    bit = 1 << (3 * x + y)
+                    if self.noughts & bit:
+                        row.append(TicTacToe.Nought)
+                    elif self.crosses & bit:
+                        row.append(TicTacToe.Cross)
+                    else:
+                        row.append(TicTacToe.Nobody)
+                state.append(row)
+            self.state_cache = state
+        return state
+
+class GameController_i(TicTacToe__POA.GameController):
+    def __init__(self, game, ptype):
+        self.game = game
+        self.ptype = ptype
+        log.debug("GameController_i created.")
+
+    @timed("GameController.play")
+    def play(self, x, y):
+        return self.game._play(x, y, self.ptype)
+
+
+class NotificationScheduler:
+    """Runs the NotificationChannels of all the games in the server on
+    a fixed pool of worker threads.
+
+    A channel is on the ready queue at most once, and a worker runs a
+    single event from it before putting it back at the end of the
+    queue, so events within a channel are delivered in order, and busy
+    games cannot starve quiet ones."""
+
+    def __init__(self, workers=NOTIFIER_WORKERS, name="Notifier"):
+        self.ready = Queue(0)
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name="%s-%d" % (name, i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            channel = self.ready.get()
+            channel._runOne()
+
+
+class NotificationChannel:
+    """An ordered queue of events, run by a NotificationScheduler.
+    Subclasses implement handle() to deliver an event, and release() to
+    drop any resources once the channel has been closed and drained."""
+
+    _CLOSE = object()
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.closed = False
+
+    def post(self, event):
+        with self.lock:
+            if self.closed:
+                return
+            schedule = self._append(event)
+
+        if schedule:
+            self.scheduler.ready.put(self)
+
+    def close(self):
+        """Release the channel after the events already posted have
+        been delivered. Later events are discarded."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            schedule = self._append(self._CLOSE)
+
+        if schedule:
+            self.scheduler.ready.put(self)
+
+    def _append(self, event):
+        """Queue event, with the lock held. Returns true if the channel
+        must be put on the ready queue."""
+        self.events.append(event)
+        if self.scheduled:
+            return False
+        self.scheduled = True
+        return True
+
+    def depth(self):
+        return len(self.events)
+
+    def _runOne(self):
+        with self.lock:
+            event = self.events.popleft()
+
+        if event is self._CLOSE:
+            with self.lock:
+                self.events.clear()
+                self.scheduled = False
+            self.release()
+            return
+
+        try:
+            self.handle(event)
+        except Exception:
+            log.exception("Error delivering notification")
+
+        with self.lock:
+            if not self.events:
+                self.scheduled = False
+                return
+
+        self.scheduler.ready.put(self)
+
+    def handle(self, event):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+class PlayerOutbox(NotificationChannel):
+    """Ordered queue of callbacks to one player. If the player cannot
+    be contacted, the game is killed."""
+
+    def __init__(self, scheduler, game, player):
+        super().__init__(scheduler)
+        self.game = game
+        self.player = player
+
+    def handle(self, event):
+        method, args = event
+        start = time.perf_counter()
+        try:
+            getattr(self.player, method)(*args)
+        except CORBA.SystemException:
+            log.warning("%s: lost contact with player", self.game.name)
+            PLAYERS_LOST.inc()
+            self.game.kill()
+        finally:
+            PLAYER_CALLBACKS.record(time.perf_counter() - start)
+
+    def release(self):
+        self.game = None
+        self.player = None
+
+
+class SpectatorNotifier(NotificationChannel):
+
+    # This channel is used to notify all the spectators about changes
+    # in the game state. Events are handed to the SpectatorFanOut, which
+    # contacts all the spectators concurrently and waits at most
+    # SPECTATOR_DEADLINE for them, so one errant spectator only delays
+    # the others by the deadline, and is dropped if it keeps timing
+    # out. The players' outboxes are run by a scheduler of their own,
+    # so no matter what happens, the players can't be held up.
+    #
+    # The spectators are read from the table's immutable snapshot,
+    # without the game's lock, which is only taken to rebuild the
+    # snapshot after spectators have come or gone, and to drop
+    # spectators. Delivery stats need no lock, since only this channel
+    # updates them, one event at a time.
     #
     # The implementation uses a simple work queue, which could
     # potentially get backed-up. Ideally, items on the queue should be
     # thrown out if they have been waiting too long.
 
-    def __init__(self, spectators, lock):
-        threading.Thread.__init__(self)
-        self.setDaemon(1)
+    def __init__(self, scheduler, spectators, lock, fanout):
+        super().__init__(scheduler)
         self.spectators = spectators
-        self.lock = lock
-        self.queue = Queue.Queue(0)
-        self.start()
-
-    def apply(func, args, kwargs=None):
-        return func(*args) if kwargs is None else func(*args, **kwargs)
+        self.game_lock = lock
+        self.fanout = fanout
+
+    def handle(self, event):
+        method, args = event
+        log.debug("Notifying: %s", method)
+        start = time.perf_counter()
+
+        entries = self.spectators.snapshot
+        if entries is None:
+            with self.game_lock:
+                entries = self.spectators.items()
+
+        targets = [(cookie, stats.spectator) for cookie, stats in entries]
+        results = self.fanout.deliver(targets, method, args)
+
+        dropped = []
+        for cookie, stats in entries:
+            outcome, latency = results[cookie]
+            stats.record(outcome)
+
+            if outcome == SpectatorFanOut.DELIVERED:
+                SPECTATOR_DELIVERIES.record(latency)
+                continue
+
+            if outcome == SpectatorFanOut.LOST:
+                log.warning("Spectator lost")
+                SPECTATORS_LOST.inc()
+            else:
+                SPECTATORS_TIMED_OUT.inc()
+                if stats.timeouts < SPECTATOR_MAX_TIMEOUTS:
+                    continue
+                log.warning("Spectator timed out")
 
-    def run(self):
-        print("SpectatorNotifier running...")
+            SPECTATORS_DROPPED.inc()
+            dropped.append(cookie)
 
-        while 1:
-            method, args = self.queue.get()
+        if dropped:
+            with self.game_lock:
+                for cookie in dropped:
+                    self.spectators.remove(cookie)
 
-            print("Notifying:", method)
+        SPECTATOR_EVENTS.record(time.perf_counter() - start)
 
-            try:
-                self.lock.acquire()
-                for i in range(len(self.spectators)):
-                    spec = self.spectators[i]
-                    if spec:
-                        try:
-                            self.apply(getattr(spec, method), args)
-                        except (CORBA.COMM_FAILURE,
-                                CORBA.OBJECT_NOT_EXIST) as ex:
-                            print("Spectator lost")
-                            self.spectators[i] = None
-            finally:
-                self.lock.release()
+    def release(self):
+        self.spectators = SpectatorTable()
 
     def up(self, state):
-        s = (state[0][:], state[1][:], state[2][:])
-        self.queue.put(("update", (s,)))
+        self.post(("update", (state,)))
 
     def end(self, state, winner):
-        self.queue.put(("end", (state, winner)))
+        self.post(("end", (state, winner)))
+
+    def updateMove(self, move):
+        self.post(("updateMove", (move,)))
+
+    def endMove(self, move, winner):
+        self.post(("endMove", (move, winner)))
 
     def gameAborted(self):
-        self.queue.put(("gameAborted", ()))
+        self.post(("gameAborted", ()))
 
 
-class GameController_i(TicTacToe__POA.GameController):
-    def __init__(self, game, ptype):
-        self.game = game
-        self.ptype = ptype
-        print("GameController_i created.")
+class SpectatorFanOut:
+    """Delivers an event to a set of spectators concurrently, using a
+    thread pool shared by all the games in the server."""
 
-    def play(self, x, y):
+    DELIVERED = "delivered"
+    TIMED_OUT = "timed out"
+    LOST      = "lost"
 
-        return self.game._play(x, y, self.ptype)
+    def __init__(self, workers=FANOUT_WORKERS, deadline=SPECTATOR_DEADLINE):
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix="FanOut")
+        self.deadline = deadline
 
+        # Calls still running after their deadline, keyed by spectator
+        # object. A spectator is skipped until its previous call has
+        # finished, so it never sees events out of order.
+        self.pending = {}
+        self.lock = threading.Lock()
 
-class SpectatorNotifier(threading.Thread):
-    def __init__(self, spectators, lock):
-        super().__init__()
-        self.setDaemon(True)
-        self.spectators = spectators
-        self.lock = lock
-        self.queue = Queue(0)
-        self.start()
+    def deliver(self, targets, method, args):
+        """Call method(*args) on each spectator in targets, a list of
+        (key, spectator) pairs. Returns a dictionary mapping each key
+        to an (outcome, latency in seconds) pair."""
 
-    def run(self):
-        print("SpectatorNotifier running...")
+        results = {}
+        futures = {}
+        started = {}  # Key -> time its call started
+
+        with self.lock:
+            for key, spec in targets:
+                if spec in self.pending:
+                    results[key] = (self.TIMED_OUT, 0.0)
+                else:
+                    future = self.executor.submit(self._call, started, key,
+                                                  spec, method, args)
+                    futures[future] = key, spec
+
+        # Only the time spent in a call counts against the deadline.
+        # Calls still queued for a worker are waited for, not failed,
+        # since it is the server that is slow, not the spectator.
+        overrun = {}
+        waiting = set(futures)
+        while waiting:
+            now = time.perf_counter()
+            timeout = self.deadline
+            for future in list(waiting):
+                start = started.get(futures[future][0])
+                if start is None:
+                    continue
+                left = start + self.deadline - now
+                if left <= 0 and not future.done():
+                    waiting.discard(future)
+                    overrun[future] = now - start
+                else:
+                    timeout = min(timeout, left)
+            if waiting:
+                waiting = wait(waiting, timeout=max(timeout, 0.0))[1]
 
+        for future, (key, spec) in futures.items():
+            if future not in overrun:
+                results[key] = future.result()
+
+        with self.lock:
+            for future, latency in overrun.items():
+                key, spec = futures[future]
+                results[key] = (self.TIMED_OUT, latency)
+                self.pending[spec] = future
+
+        # Outside the lock, since a future that has finished meanwhile
+        # runs its callback here, and the callback takes the lock
+        for future in overrun:
+            spec = futures[future][1]
+            future.add_done_callback(
+                lambda f, spec=spec: self._finished(spec, f))
+
+        return results
+
+    def _finished(self, spec, future):
+        with self.lock:
+            if self.pending.get(spec) is future:
+                del self.pending[spec]
+
+    def _call(self, started, key, spec, method, args):
+        start = started[key] = time.perf_counter()
+        try:
+            getattr(spec, method)(*args)
+            outcome = self.DELIVERED
+        except CORBA.TRANSIENT:
+            # Raised by omniORB when the client call timeout expires
+            outcome = self.TIMED_OUT
+        except CORBA.SystemException:
+            outcome = self.LOST
+        return outcome, time.perf_counter() - start
+
+
+class SpectatorTable:
+    """The spectators registered with a game.
+
+    Entries live in numbered slots, and freed slots are reused. A
+    cookie holds the slot number in its low SLOT_BITS bits, and the
+    slot's generation above that. The generation starts at a random
+    value and changes every time the slot is freed, so a stale or
+    guessed cookie does not unregister someone else. The slots in use
+    are also kept in a dense list, so iteration only visits live
+    entries.
+
+    The table is changed with its owner's lock held. snapshot is an
+    immutable tuple of the (cookie, entry) pairs, or None if the table
+    has changed since it was taken; readers that find a tuple can use
+    it without the lock."""
+
+    SLOT_BITS = 16
+    SLOT_MASK = (1 << SLOT_BITS) - 1
+    GENERATION_MASK = (1 << (32 - SLOT_BITS)) - 1
+
+    def __init__(self):
+        self.entries = []      # Slot -> entry, or None if free
+        self.generations = []  # Slot -> generation
+        self.positions = []    # Slot -> index in self.live
+        self.live = []         # Slots in use
+        self.free = []         # Slots not in use
+        self.snapshot = ()
+
+    def __len__(self):
+        return len(self.live)
+
+    def add(self, entry):
+        """Store entry in a free slot and return its cookie."""
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.entries)
+            if slot > self.SLOT_MASK:
+                raise CORBA.IMP_LIMIT(0, CORBA.COMPLETED_NO)
+            self.entries.append(None)
+            self.generations.append(random.getrandbits(32 - self.SLOT_BITS))
+            self.positions.append(0)
+
+        self.entries[slot] = entry
+        self.positions[slot] = len(self.live)
+        self.live.append(slot)
+        self.snapshot = None
+        return self.generations[slot] << self.SLOT_BITS | slot
+
+    def remove(self, cookie):
+        """Remove the entry for cookie, returning it, or None if the
+        cookie is not current."""
+        slot = cookie & self.SLOT_MASK
+        generation = cookie >> self.SLOT_BITS
+
+        if slot >= len(self.entries) or self.entries[slot] is None or \
+                self.generations[slot] != generation:
+            return None
+
+        entry = self.entries[slot]
+        self.entries[slot] = None
+        self.generations[slot] = (generation + 1) & self.GENERATION_MASK
+
+        # Move the last live slot into the hole
+        pos = self.positions[slot]
+        last = self.live.pop()
+        if last != slot:
+            self.live[pos] = last
+            self.positions[last] = pos
+
+        self.free.append(slot)
+        self.snapshot = None
+        return entry
+
+    def items(self):
+        """Return a tuple of (cookie, entry) pairs for the live
+        entries, rebuilding the snapshot if need be. Called with the
+        owner's lock held."""
+        items = self.snapshot
+        if items is None:
+            items = self.snapshot = tuple(
+                (self.generations[slot] << self.SLOT_BITS | slot,
+                 self.entries[slot]) for slot in self.live)
+        return items
+
+
+class DeliveryStats:
+    """Consecutive timeout count for one spectator. Delivery latencies
+    are recorded in the Spectator.delivery histogram."""
+
+    def __init__(self, spectator):
+        self.spectator = spectator
+        self.timeouts = 0
+
+    def record(self, outcome):
+        if outcome == SpectatorFanOut.TIMED_OUT:
+            self.timeouts += 1
+        else:
+            self.timeouts = 0
+
+
+class Lobby:
+    """The lobby change feed of a game factory.
+
+    Each change is given the next version number and posted to every
+    subscriber's LobbyFeed, so publishing costs O(subscribers), however
+    many games there are. Only subscribing costs O(games), for the
+    snapshot."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.version = 0
+        self.feeds = SpectatorTable()  # Cookies are made the same way
+        metrics.gauge("Lobby.subscribers", lambda: len(self.feeds))
+
+    def subscribe(self, listener, games):
+        """Subscribe listener to the feed. games is a function that
+        returns the lobby entries of the active games; the caller must
+        hold the lock its changes are published under, so that they
+        match the version. Returns the entries, the version and the
+        subscription's cookie."""
+
+        omniORB.setClientCallTimeout(listener,
+                                     int(SPECTATOR_DEADLINE * 1000))
+        with self.lock:
+            feed = LobbyFeed(self.scheduler, self, listener)
+            feed.cookie = self.feeds.add(feed)
+            return games(), self.version, feed.cookie
+
+    def unsubscribe(self, cookie):
+        with self.lock:
+            feed = self.feeds.remove(cookie)
+        if feed is not None:
+            feed.close()
+
+    def publish(self, kind, name, obj, players):
+        """Send a change to all the subscribers. obj is only needed
+        for GameAdded."""
+        with self.lock:
+            self.version = (self.version + 1) & 0xffffffff
+            change = TicTacToe.LobbyChange(
+                self.version, kind,
+                TicTacToe.LobbyGame(TicTacToe.GameInfo(name, obj), players))
+
+            for cookie, feed in self.feeds.items():
+                feed.post(change)
+
+
+class LobbyFeed(NotificationChannel):
+    """Delivers lobby changes to one subscriber, in batches of the
+    changes that have queued up while the last call was made. A
+    subscriber that cannot be contacted is unsubscribed."""
+
+    def __init__(self, scheduler, lobby, listener):
+        super().__init__(scheduler)
+        self.lobby = lobby
+        self.listener = listener
+        self.cookie = None
+
+    def _append(self, change):
+        if len(self.events) >= LOBBY_MAX_BACKLOG:
+            # The channel is already scheduled, since it has events
+            self.events.clear()
+            self.events.append(change)
+            LOBBY_OVERFLOWS.inc()
+            return False
+
+        return super()._append(change)
+
+    def handle(self, change):
+        changes = [change]
+        with self.lock:
+            while self.events and len(changes) < LOBBY_BATCH and \
+                    self.events[0] is not self._CLOSE:
+                changes.append(self.events.popleft())
+
+        start = time.perf_counter()
+        try:
+            self.listener.lobbyChanged(changes)
+            LOBBY_DELIVERIES.record(time.perf_counter() - start)
+        except CORBA.TRANSIENT:
+            # Timed out. The subscriber sees the gap if it recovers.
+            LOBBY_TIMED_OUT.inc()
+        except CORBA.SystemException:
+            log.warning("Lobby subscriber lost")
+            LOBBY_LOST.inc()
+            self.lobby.unsubscribe(self.cookie)
+
+    def release(self):
+        self.lobby = None
+        self.listener = None
+
+
+class MatchMaker:
+    """Pairs the players of GameFactory::quickJoin(), using factory's
+    newGame() and the games' joinGameAs(), so it works the same with
+    local and remote factories.
+
+    Each player without an opponent is seated as noughts in a new game,
+    which goes on a queue; the next player takes the game at the front
+    and joins it. Games that have since been filled or killed are
+    dropped as they are reached, so pairing is O(1) amortised.
+
+    The lock only guards the queue; the remote calls are made without
+    it. One player at a time creates a game, and players who find the
+    queue empty meanwhile wait for that game, rather than each waiting
+    in a game of their own."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.waiting = deque()  # (Game, time.monotonic() when queued)
+        self.creating = False   # A player is creating a game
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.names = itertools.count(1)
+        metrics.gauge("QuickJoin.waiting", lambda: len(self.waiting))
+
+    def quickJoin(self, player, player_name):
         while True:
-            method, args = self.queue.get()
-            print("Notifying:", method)
+            with self.lock:
+                while self.creating and not self.waiting:
+                    self.changed.wait()
+
+                if not self.waiting:
+                    self.creating = True
+                    break
+
+                game, queued = self.waiting.popleft()
+
+            try:
+                controller, ptype = game.joinGameAs(player, player_name)
+            except (TicTacToe.Game.CannotJoin, CORBA.OBJECT_NOT_EXIST):
+                continue
 
+            TIME_TO_MATCH.record(time.monotonic() - queued)
+            return controller, game, ptype
+
+        entry = None
+        try:
+            game = self._newGame()
+            try:
+                controller, ptype = game.joinGameAs(player, player_name)
+            except Exception:
+                # Nobody else will be sent to it, so get rid of it
+                try:
+                    game.kill()
+                except CORBA.SystemException:
+                    pass
+                raise
+
+            entry = (game, time.monotonic())
+            return controller, game, ptype
+
+        finally:
             with self.lock:
-                for i, spec in enumerate(self.spectators):
-                    if spec:
-                        try:
-                            getattr(spec, method)(*args)
-                        except (CORBA.COMM_FAILURE, CORBA.OBJECT_NOT_EXIST):
-                            print("Spectator lost")
-                            self.spectators[i] = None
+                self.creating = False
+                if entry is not None:
+                    self.waiting.append(entry)
+                self.changed.notify_all()
 
+    def _newGame(self):
+        while True:
+            name = QUICK_GAME_PREFIX + str(next(self.names))
+            try:
+                return self.factory.newGame(name)
+            except TicTacToe.GameFactory.NameInUse:
+                pass
 
-def main(argv):
-    print("Game Server starting...")
 
-    orb = CORBA.ORB_init(argv, CORBA.ORB_ID)
-    poa = orb.resolve_initial_references("RootPOA")
-    poa._get_the_POAManager().activate()
+STATUSES = (TicTacToe.Waiting, TicTacToe.InProgress, TicTacToe.Finished)
 
-    gf_impl = GameFactory_i(poa)
-    gf_id = poa.activate_object(gf_impl)
-    gf_obj = poa.id_to_reference(gf_id)
 
-    print(orb.object_to_string(gf_obj))
+class GameIndex:
+    """Indexes of a factory's games by status and name.
 
-    try:
-        nameRoot = orb.string_to_object("IOR:010000002b00000049444c3a6f6d672e6f72672f436f734e616d696e672f4e616d696e67436f6e746578744578743a312e300000010000000000000070000000010102000e0000003139322e3136382e312e31303500f90a0b0000004e616d6553657276696365000300000000000000080000000100000000545441010000001c0000000100000001000100010000000100010509010100010000000901010003545441080000009c9b546701006a14")
+    For each status, the names of the games with that status are kept
+    in a sorted list, so a query by status and name prefix is a binary
+    search for the start, then a walk along the names that match, and
+    costs O(log n + page size) however many games there are. Changing a
+    game's status moves its name from one list to another."""
 
-        nameRoot = nameRoot._narrow(CosNaming.NamingContext)
-        if nameRoot is None:
-            print("NameService narrow failed!")
-            sys.exit(1)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = dict((status, []) for status in STATUSES)
+        self.entries = {}  # Name -> (status, GameInfo)
+
+        # Finished games, oldest first, as (sequence number, name), and
+        # the sequence number each finished name was last given
+        self.finished = deque()
+        self.finished_seq = itertools.count()
+        self.finished_at = {}
+
+    def _insert(self, name, status, info):
+        self.entries[name] = (status, info)
+        insort(self.names[status], name)
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            names = self.names[entry[0]]
+            del names[bisect_left(names, name)]
+        return entry
+
+    def add(self, name, obj, players):
+        """Index a new game, replacing any finished game of the same
+        name."""
+        with self.lock:
+            self._remove(name)
+            self.finished_at.pop(name, None)
+            self._insert(name, self._status(players),
+                         TicTacToe.GameInfo(name, obj))
+
+    def _status(self, players):
+        return TicTacToe.InProgress if players == 2 else TicTacToe.Waiting
+
+    def setPlayers(self, name, players):
+        with self.lock:
+            entry = self.entries.get(name)
+            status = self._status(players)
+            if entry is not None and entry[0] != status:
+                self._remove(name)
+                self._insert(name, status, entry[1])
+
+    def finish(self, name):
+        with self.lock:
+            entry = self._remove(name)
+            if entry is None:
+                return
+            self._insert(name, TicTacToe.Finished, entry[1])
+
+            seq = next(self.finished_seq)
+            self.finished_at[name] = seq
+            self.finished.append((seq, name))
+
+            while len(self.finished) > FINISHED_KEPT:
+                seq, name = self.finished.popleft()
+                if self.finished_at.get(name) == seq:
+                    del self.finished_at[name]
+                    self._remove(name)
+
+    def query(self, statuses, prefix, start_after, how_many):
+        """Return a list of up to how_many GameInfo for the games with
+        one of statuses, whose names start with prefix, in name order,
+        after start_after, and whether there are more."""
+
+        with self.lock:
+            walks = []
+            for status in set(statuses):
+                names = self.names[status]
+                start = max(bisect_left(names, prefix),
+                            bisect_right(names, start_after))
+                walks.append(map(names.__getitem__,
+                                 range(start, len(names))))
+
+            matches = itertools.takewhile(lambda name: name.startswith(prefix),
+                                          heapq.merge(*walks))
+            page = list(itertools.islice(matches, how_many + 1))
+            ret = [self.entries[name][1] for name in page[:how_many]]
+
+        return ret, len(page) > how_many
+
+
+class Stats_i(TicTacToe__POA.Stats):
+    """Serves the metrics of this process."""
+
+    def _get_uptime(self):
+        return time.time() - metrics.started
+
+    def snapshot(self):
+        snap = metrics.snapshot()
+
+        counters = [TicTacToe.Sample(name, float(value))
+                    for name, value in sorted(snap["counters"].items())]
+        gauges = [TicTacToe.Sample(name, float(value))
+                  for name, value in sorted(snap["gauges"].items())
+                  if value is not None]
+        latencies = [TicTacToe.LatencySummary(name, h["count"], h["sum"],
+                                              h["p50"], h["p90"], h["p99"],
+                                              h["max"])
+                     for name, h in sorted(snap["histograms"].items())]
+
+        return counters, gauges, latencies
+
+
+class Results_i(TicTacToe__POA.Results):
+    """Answers queries on the results of finished games."""
+
+    def __init__(self, store):
+        self.store = store
+
+    @timed("Results.recentResults")
+    def recentResults(self, player_name, how_many):
+        ret = self.store.recent(player_name, int(how_many))
+        if ret is None:
+            raise TicTacToe.Results.UnknownPlayer()
+        return ret
+
+    @timed("Results.findPlayer")
+    def findPlayer(self, player_name):
+        ret = self.store.player(player_name)
+        if ret is None:
+            raise TicTacToe.Results.UnknownPlayer()
+        return ret
 
+    @timed("Results.leaderboard")
+    def leaderboard(self, how_many):
+        return self.store.leaderboard(int(how_many))
+
+
+def bindService(poa, context, servant, name, shard=None):
+    """Activate servant, and bind it in context as name, or as
+    "name-<shard>" in a shard."""
+
+    if shard is not None:
+        name += "-" + shard
+
+    obj = poa.id_to_reference(poa.activate_object(servant))
+    context.rebind([CosNaming.NameComponent(name, "")], obj)
+    log.info("%s bound in NameService.", name)
+
+
+def startStats(argv, poa, context, shard=None):
+    """Bind a Stats object, as "Stats", or "Stats-<shard>" in a shard,
+    and start writing snapshots to the file given by -statsFile, if
+    any. Shards add "-<shard>" to the file name too."""
+
+    bindService(poa, context, Stats_i(), "Stats", shard)
+
+    path = getOption(argv, "-statsFile")
+    if path and shard is not None:
+        path += "-" + shard
+
+    if path:
+        interval = float(getOption(argv, "-statsInterval", STATS_INTERVAL))
+        gameMetrics.SnapshotWriter(path, interval)
+
+
+def checkName(name):
+    """Raise BAD_PARAM if name is too long to be stored."""
+    if len(name.encode("utf-8")) > MAX_NAME_BYTES:
+        raise CORBA.BAD_PARAM(0, CORBA.COMPLETED_NO)
+
+
+def getOption(argv, option, default=None):
+    """Return the value following option in argv, or default."""
+    if option in argv:
+        return argv[argv.index(option) + 1]
+    return default
+
+
+def getTutorialContext(orb):
+    """Return the "tutorial" naming context, creating it if need be."""
+
+    try:
+        nameRoot = orb.resolve_initial_references("NameService")
     except CORBA.ORB.InvalidName:
-        print("InvalidName when resolving NameService!")
+        nameRoot = orb.string_to_object(NAMESERVICE_IOR)
+
+    nameRoot = nameRoot._narrow(CosNaming.NamingContext)
+    if nameRoot is None:
+        log.error("NameService narrow failed!")
         sys.exit(1)
 
     name = [CosNaming.NameComponent("tutorial", "")]
     try:
         tutorialContext = nameRoot.bind_new_context(name)
     except CosNaming.NamingContext.AlreadyBound:
-        print('Reusing "tutorial" naming context.')
+        log.info('Reusing "tutorial" naming context.')
         tutorialContext = nameRoot.resolve(name)
         tutorialContext = tutorialContext._narrow(CosNaming.NamingContext)
         if tutorialContext is None:
-            print('The name "tutorial" is already bound.')
+            log.error('The name "tutorial" is already bound.')
             sys.exit(1)
 
-    tutorialContext.rebind([CosNaming.NameComponent("GameFactory", "")], gf_obj)
-    print("GameFactory bound in NameService.")
+    return tutorialContext
+
+
+def main(argv):
+    orb = CORBA.ORB_init(argv, CORBA.ORB_ID)
+
+    gameLog.start(getOption(argv, "-logLevel", gameLog.LOG_LEVEL))
+    log.info("Game Server starting...")
+
+    poa = orb.resolve_initial_references("RootPOA")
+    poa._get_the_POAManager().activate()
+
+    iterator_ttl = float(getOption(argv, "-iteratorTTL", ITERATOR_TTL))
+
+    # Work out, or load, the computer player's moves before taking
+    # any games
+    gameBot.loadTable(getOption(argv, "-botTable"))
+
+    # A shard of a sharded server (see shardServer.py) is bound under
+    # its own name, for the routing factory to find.
+    shard = getOption(argv, "-shard")
+    if shard is None:
+        bind_name = "GameFactory"
+    else:
+        bind_name = "GameFactory-" + shard
+
+    # With -journal, games are journalled in the given directory, and
+    # recovered from it on startup; see gameJournal.py. The factory and
+    # games are then in persistent POAs, so references to them still
+    # work after a restart, as long as the server listens on the same
+    # endpoint each time, e.g. with -ORBendPoint giop:tcp::9999.
+    journal_dir = getOption(argv, "-journal")
+    if journal_dir is None:
+        journal = None
+
+    elif not SINGLE_GAME_POA:
+        log.error("The journal needs SINGLE_GAME_POA.")
+        sys.exit(1)
+
+    else:
+        if shard is not None:
+            journal_dir = os.path.join(journal_dir, "shard-" + shard)
+        journal = gameJournal.Journal(journal_dir, orb)
+
+    # Results are kept in memory, and with -results, in a file too
+    results_file = getOption(argv, "-results")
+    if results_file and shard is not None:
+        results_file += "-" + shard
+    results = gameResults.ResultStore(results_file)
+
+    gf_impl = GameFactory_i(poa, iterator_ttl, journal, results)
+
+    if journal is None:
+        gf_id = poa.activate_object(gf_impl)
+        gf_obj = poa.id_to_reference(gf_id)
+    else:
+        ps = [poa.create_lifespan_policy(PortableServer.PERSISTENT),
+              poa.create_id_assignment_policy(PortableServer.USER_ID)]
+        factory_poa = poa.create_POA("FactoryPOA", None, ps)
+        factory_poa.activate_object_with_id(b"GameFactory", gf_impl)
+        factory_poa._get_the_POAManager().activate()
+        gf_obj = factory_poa.id_to_reference(b"GameFactory")
+
+        gf_impl._recover(journal.recover())
+        journal.start(gf_impl._gameRecords)
+
+    print(orb.object_to_string(gf_obj))
+
+    tutorialContext = getTutorialContext(orb)
+    tutorialContext.rebind([CosNaming.NameComponent(bind_name, "")], gf_obj)
+    log.info("%s bound in NameService.", bind_name)
+
+    startStats(argv, poa, tutorialContext, shard)
+    bindService(poa, tutorialContext, Results_i(results), "Results", shard)
 
     orb.run()
 
 
 if __name__ == "__main__":
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+
+# gameSession.py
+#
+# Headless client library for the game server. A GameClient connects
+# to a GameFactory and can list, create, find, join and watch games,
+# and follow the lobby. Joining or watching a game gives a session
+# object, a Player or Spectator servant that turns the server's
+# callbacks into GameEvents, delivered to a listener function or
+# queued on the session. Nothing here uses a GUI, so the same code
+# serves the Tk client, bots and the benchmark, which may run
+# thousands of sessions in one process.
+
+import threading
+import time
+from collections import namedtuple
+from queue import Queue
+from omniORB import CORBA
+import TicTacToe
+import TicTacToe__POA
+
+# The default way to find the GameFactory: a corbaname URI resolved
+# through the ORB's NameService initial reference.
+FACTORY_URI = "corbaname:rir:#tutorial/GameFactory"
+RESULTS_URI = "corbaname:rir:#tutorial/Results"
+
+# kind is one of "yourGo", "update", "end" or "aborted". state is the
+# session's copy of the game state, and winner is only set for "end".
+GameEvent = namedtuple("GameEvent", "session kind state winner")
+
+
+def connect(argv, uri=FACTORY_URI):
+    """Initialise the ORB and return a GameClient for the GameFactory
+    at uri, which may be an IOR or corbaname URI. CORBA exceptions
+    propagate to the caller."""
+
+    orb = CORBA.ORB_init(argv, CORBA.ORB_ID)
+    factory = orb.string_to_object(uri)._narrow(TicTacToe.GameFactory)
+    if factory is None:
+        raise CORBA.BAD_PARAM(0, CORBA.COMPLETED_NO)
+
+    return GameClient(orb, factory)
+
+
+class GameClient:
+    """A connection to a GameFactory, with a POA for the session
+    objects."""
+
+    def __init__(self, orb, factory):
+        self.orb = orb
+        self.factory = factory
+        self.poa = orb.resolve_initial_references("RootPOA")
+        self.poa._get_the_POAManager().activate()
+        self.pager = GameListPager(factory)
+
+    def listGames(self):
+        """Return a list of GameSummary for all the games. self.pager
+        has the timings of the last listing."""
+        games = []
+        for seq in self.pager.pages():
+            games.extend(seq)
+        return games
+
+    def describeGames(self, names):
+        """Return a list of GameSummary for the named games that
+        exist."""
+        return self.factory.describeGames(list(names))
+
+    def queryGames(self, statuses=(), prefix="", how_many=100,
+                   start_after=""):
+        """Return a list of GameInfo for the games matching a query,
+        and whether there are more, as GameFactory::queryGames()."""
+        return self.factory.queryGames(list(statuses), prefix, start_after,
+                                       how_many)
+
+    def newGame(self, name):
+        return self.factory.newGame(name)
+
+    def findGame(self, name):
+        return self.factory.findGame(name)
+
+    def join(self, game, listener=None, player_name=""):
+        return PlayerSession(self, game, listener).join(player_name)
+
+    def quickJoin(self, listener=None, player_name=""):
+        return PlayerSession(self, None, listener).quickJoin(player_name)
+
+    def watch(self, game, listener=None):
+        return SpectatorSession(self, game, listener).watch()
+
+    def lobby(self, listener=None):
+        return LobbySession(self, listener).subscribe()
+
+    def results(self, uri=RESULTS_URI):
+        """Return the server's Results object."""
+        return self.orb.string_to_object(uri)._narrow(TicTacToe.Results)
+
+    def shutdown(self):
+        self.orb.shutdown(0)
+
+
+class GameListPager:
+    """Fetches the list of games from a GameFactory a page at a time.
+
+    The first page comes back from listGames() itself. Later pages are
+    fetched from the iterator with a batch size that grows while round
+    trips stay fast and shrinks again if they get slow. While the
+    caller is consuming one page, the next one is already being
+    fetched on a background thread."""
+
+    FIRST_BATCH = 64
+    MAX_BATCH   = 4096
+    GROWTH      = 4
+    TARGET_TIME = 0.25  # seconds per round trip before we stop growing
+
+    def __init__(self, gameFactory):
+        self.gameFactory = gameFactory
+        self.timings = []
+        self.count = 0
+        self.elapsed = 0.0
+
+    def pages(self):
+        """Generator yielding sequences of GameSummary. CORBA exceptions
+        from the factory or iterator propagate to the caller. The
+        server's iterator is destroyed even if the caller stops
+        early."""
+
+        self.timings = []
+        self.count = 0
+        start = time.perf_counter()
+
+        batch = self.FIRST_BATCH
+        seq, iterator = self._timed(self.gameFactory.listGames, batch)
+        more = iterator is not None
+        prefetch = None
+
+        try:
+            while True:
+                prefetch = None
+                if more:
+                    batch = self._nextBatch(batch)
+                    prefetch = _Prefetch(self._timed, iterator.next_n, batch)
+
+                self.count += len(seq)
+                yield seq
+
+                if prefetch is None:
+                    break
+
+                seq, more = prefetch.result()
+
+        finally:
+            # A fetch still in progress must finish before the iterator
+            # is destroyed under it
+            if prefetch is not None:
+                prefetch.join()
+            if iterator is not None:
+                try:
+                    iterator.destroy()
+                except CORBA.SystemException:
+                    pass
+
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        return "%d games in %d round trips, %.1f ms" % (
+            self.count, len(self.timings), self.elapsed * 1000)
+
+    def _nextBatch(self, batch):
+        if self.timings and self.timings[-1] > self.TARGET_TIME:
+            return max(self.FIRST_BATCH, batch // self.GROWTH)
+        return min(self.MAX_BATCH, batch * self.GROWTH)
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.timings.append(time.perf_counter() - start)
+
+
+class _Prefetch(threading.Thread):
+    """Runs a single call on a background thread, keeping its result
+    or exception until result() is called."""
+
+    def __init__(self, func, *args):
+        super().__init__(daemon=True)
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as ex:
+            self.error = ex
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class LobbySession(TicTacToe__POA.LobbyListener):
+    """A copy of the factory's lobby, kept up to date by its change
+    feed: games maps the names of the active games, in creation order,
+    to LobbyGames. If changes are missed, the session subscribes again
+    for a fresh snapshot.
+
+    After each batch of changes, listener, if given, is called on an
+    ORB thread with the session and the list of changes applied, or
+    None if the whole lobby has been replaced. It should look up the
+    games concerned with find(), since a later batch may already have
+    been applied."""
+
+    def __init__(self, client, listener=None):
+        self.client = client
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.games = {}
+        self.version = None  # None until subscribed
+        self.cookie = None
+        self.id = None
+
+    def subscribe(self):
+        """Subscribe to the change feed, or subscribe again, replacing
+        the lobby. CORBA exceptions propagate to the caller. Returns
+        self."""
+        with self.lock:
+            if self.id is None:
+                self.id = self.client.poa.activate_object(self)
+            obj = self.client.poa.id_to_reference(self.id)
+
+            self._unsubscribe()
+            games, self.version, self.cookie = \
+                self.client.factory.subscribeLobby(obj)
+            self.games = dict((g.game.name, g) for g in games)
+
+        if self.listener is not None:
+            self.listener(self, None)
+        return self
+
+    def _unsubscribe(self):
+        if self.cookie is not None:
+            try:
+                self.client.factory.unsubscribeLobby(self.cookie)
+            except CORBA.SystemException:
+                pass
+            self.cookie = None
+
+    def close(self):
+        """Stop following the lobby."""
+        with self.lock:
+            self._unsubscribe()
+            self.version = None
+            if self.id is not None:
+                self.client.poa.deactivate_object(self.id)
+                self.id = None
+
+    def listGames(self):
+        """Return a list of the LobbyGames, in creation order."""
+        with self.lock:
+            return list(self.games.values())
+
+    def find(self, name):
+        """Return the LobbyGame of the named game, or None."""
+        with self.lock:
+            return self.games.get(name)
+
+    def _apply(self, change):
+        game = change.game
+        name = game.game.name
+        if change.kind == TicTacToe.GameAdded:
+            self.games[name] = game
+        elif change.kind == TicTacToe.GameRemoved:
+            self.games.pop(name, None)
+        else:
+            old = self.games.get(name)
+            if old is not None:
+                self.games[name] = TicTacToe.LobbyGame(old.game, game.players)
+
+    # CORBA methods
+    def lobbyChanged(self, changes):
+        applied = []
+        with self.lock:
+            if self.version is None:
+                return
+
+            for change in changes:
+                step = (change.version - self.version) & 0xffffffff
+                if step == 0 or step & 0x80000000:
+                    continue  # Already in the snapshot
+                if step != 1:
+                    break
+                self.version = change.version
+                self._apply(change)
+                applied.append(change)
+            else:
+                changes = None
+
+        if changes is not None:
+            # Missed some
+            try:
+                self.subscribe()
+            except CORBA.SystemException as ex:
+                print("System exception trying to resubscribe to lobby:")
+                print("  ", CORBA.id(ex), ex)
+
+        elif applied and self.listener is not None:
+            self.listener(self, applied)
+
+
+class MoveTracker:
+    """Keeps a local copy of a game's state, built up from the Move
+    events sent by the server. If a move is missed, the whole state is
+    fetched again with Game::resync(), unless the game is already gone,
+    in which case the move is applied anyway."""
+
+    def initBoard(self, state):
+        self.board = [list(row) for row in state]
+        self.seq = sum(1 for row in state for cell in row
+                       if cell != TicTacToe.Nobody)
+
+    def applyState(self, state):
+        """Take a full state from the server, unless we have already
+        seen a later move."""
+        seq = sum(1 for row in state for cell in row
+                  if cell != TicTacToe.Nobody)
+        if seq >= self.seq:
+            self.board = [list(row) for row in state]
+            self.seq = seq
+        return self.board
+
+    def applyMove(self, move):
+        """Apply a move, returning the new state."""
+        if move.seq <= self.seq:
+            return self.board
+
+        if move.seq == self.seq + 1:
+            self.board[move.x][move.y] = move.who
+            self.seq = move.seq
+            return self.board
+
+        try:
+            if self.game is None:
+                raise CORBA.OBJECT_NOT_EXIST(0, CORBA.COMPLETED_NO)
+            state, seq = self.game.resync()
+            self.board = [list(row) for row in state]
+            self.seq = seq
+
+        except CORBA.OBJECT_NOT_EXIST:
+            # The game is over. This is the last move, so it is the best
+            # that can be had of the final board.
+            self.board[move.x][move.y] = move.who
+            self.seq = move.seq
+
+        except CORBA.SystemException as ex:
+            print("System exception trying to resync game:")
+            print("  ", CORBA.id(ex), ex)
+
+        return self.board
+
+
+class GameSession(MoveTracker):
+    """Base class for the sessions. Subclasses may override onEvent(),
+    otherwise events go to the listener function given to the
+    constructor, or if there is none, to a queue read with
+    nextEvent()."""
+
+    def __init__(self, client, game, listener=None):
+        self.client = client
+        self.game = game
+        self.listener = listener
+        self.events = Queue(0) if listener is None else None
+        self.id = None
+
+        n = TicTacToe.Nobody
+        self.initBoard([[n, n, n], [n, n, n], [n, n, n]])
+
+    def onEvent(self, event):
+        if self.listener is not None:
+            self.listener(event)
+        else:
+            self.events.put(event)
+
+    def nextEvent(self, timeout=None):
+        """Wait for the next queued event. Raises queue.Empty if there
+        is none within timeout seconds."""
+        return self.events.get(timeout=timeout)
+
+    def _emit(self, kind, state, winner=None):
+        self.onEvent(GameEvent(self, kind, state, winner))
+
+    def detach(self):
+        """Stop receiving events, without telling the server."""
+        if self.id is not None:
+            self.client.poa.deactivate_object(self.id)
+            self.id = None
+
+    def _activate(self):
+        self.id = self.client.poa.activate_object(self)
+        return self.client.poa.id_to_reference(self.id)
+
+
+class PlayerSession(GameSession, TicTacToe__POA.Player):
+    """A player in a game. Call join() to join the game, or quickJoin()
+    to be matched with an opponent, then play() when a "yourGo" event
+    arrives."""
+
+    def __init__(self, client, game, listener=None):
+        super().__init__(client, game, listener)
+
+        # The opponent can move, and our first callback arrive, before
+        # the reply to joinGame() has, so callbacks wait for this.
+        self.joined = threading.Event()
+
+        # (seq, x, y) of the move being made by play(). The opponent's
+        # reply can arrive before play() returns.
+        self.playing = None
+
+    def join(self, player_name=""):
+        """Join the game, raising Game.CannotJoin if it is full. If
+        player_name is given, the game's result is recorded under it.
+        Returns self."""
+        obj = self._activate()
+        try:
+            if player_name:
+                self.controller, self.ptype = \
+                    self.game.joinGameAs(obj, player_name)
+            else:
+                self.controller, self.ptype = self.game.joinGame(obj)
+        except:
+            self.detach()
+            raise
+        finally:
+            self.joined.set()
+        return self
+
+    def quickJoin(self, player_name=""):
+        """Join a game with the next player looking for an opponent,
+        with GameFactory::quickJoin(). The session's game is set to the
+        game joined. Returns self."""
+        obj = self._activate()
+        try:
+            self.controller, self.game, self.ptype = \
+                self.client.factory.quickJoin(obj, player_name)
+        except:
+            self.detach()
+            raise
+        finally:
+            self.joined.set()
+        return self
+
+    def _emit(self, kind, state, winner=None):
+        self.joined.wait()
+        super()._emit(kind, state, winner)
+
+    def play(self, x, y):
+        """Play at square (x, y), returning the new state. The
+        GameController exceptions propagate to the caller."""
+        self.playing = (self.seq + 1, x, y)
+        try:
+            return self.applyState(self.controller.play(x, y))
+        finally:
+            self.playing = None
+
+    def applyMove(self, move):
+        # A quickJoin() session has no game to resync with until the
+        # reply has arrived
+        self.joined.wait()
+
+        # Fill in our own move if the reply to it has overtaken play()
+        playing = self.playing
+        if playing is not None and move.seq == playing[0] + 1 and \
+           self.seq == playing[0] - 1:
+            seq, x, y = playing
+            self.board[x][y] = self.ptype
+            self.seq = seq
+        return super().applyMove(move)
+
+    def close(self, kill=True):
+        """Stop receiving events, and by default kill the game."""
+        self.detach()
+        if kill:
+            self.game.kill()
+
+    # CORBA methods
+    def yourGo(self, state):
+        self._emit("yourGo", self.applyState(state))
+
+    def yourGoMove(self, last):
+        self._emit("yourGo", self.applyMove(last))
+
+    def end(self, state, winner):
+        self._emit("end", self.applyState(state), winner)
+
+    def endMove(self, last, winner):
+        self._emit("end", self.applyMove(last), winner)
+
+    def gameAborted(self):
+        self._emit("aborted", self.board)
+
+
+class SpectatorSession(GameSession, TicTacToe__POA.Spectator):
+    """A spectator of a game. Call watch() to start watching."""
+
+    def watch(self):
+        """Start watching the game. Returns self."""
+        obj = self._activate()
+        try:
+            self.cookie, state = self.game.watchGame(obj)
+        except:
+            self.detach()
+            raise
+        self.applyState(state)
+        return self
+
+    def close(self):
+        """Stop watching the game."""
+        self.detach()
+        self.game.unwatchGame(self.cookie)
+
+    # CORBA methods
+    def update(self, state):
+        self._emit("update", self.applyState(state))
+
+    def updateMove(self, m):
+        self._emit("update", self.applyMove(m))
+
+    def end(self, state, winner):
+        self._emit("end", self.applyState(state), winner)
+
+    def endMove(self, last, winner):
+        self._emit("end", self.applyMove(last), winner)
+
+    def gameAborted(self):
+        self._emit("aborted", self.board)
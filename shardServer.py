@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# shardServer.py
+#
+# Runs the game server as several worker processes, each an ordinary
+# gameServer.py hosting a share of the games, behind a routing
+# GameFactory. Clients find the routing factory as "GameFactory" in
+# the NameService, as usual; the games it hands out live directly in
+# the workers, so moves never pass through the front process.
+#
+# usage: shardServer.py [-shards N] [-iteratorTTL seconds]
+#                       [-statsFile file] [-statsInterval seconds]
+#                       [-logLevel level]
+#                       [ORB options]
+#
+# The ORB options, e.g. -ORBInitRef NameService=corbaname::localhost,
+# are passed on to the workers as well. Each process has its own
+# metrics: the front's are bound as "Stats", and worker i's as
+# "Stats-i".
+#
+# The routing factory follows the lobby change feed of every worker,
+# and serves a merged feed of its own, so lobby subscribers need only
+# one subscription, whatever the number of shards.
+
+import atexit
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+import CORBA
+import CosNaming
+import TicTacToe
+import TicTacToe__POA
+
+import gameLog
+from gameLog import log
+from gameMetrics import timed
+from gameServer import ITERATOR_TTL, IteratorRegistry, Lobby, MatchMaker, \
+    NotificationScheduler, getOption, getTutorialContext, startStats
+
+SHARDS = os.cpu_count() or 1
+
+# How long to wait for a worker to appear in the NameService
+WORKER_START_TIMEOUT = 30
+
+
+class RoutingGameFactory_i(IteratorRegistry, TicTacToe__POA.GameFactory):
+    """A GameFactory that places each game on one of a set of shard
+    factories, chosen by a hash of the game name, and merges their
+    game lists."""
+
+    def __init__(self, poa, shards, iterator_ttl=ITERATOR_TTL):
+        self.shards = shards
+        self._initIterators(poa, iterator_ttl)
+
+        # The merged lobby. The shards' changes are republished with
+        # lobby_lock held.
+        self.lobby = Lobby(NotificationScheduler())
+        self.lobby_lock = threading.Lock()
+        self.shard_lobbies = [ShardLobby_i(self, poa, shard)
+                              for shard in shards]
+
+        # Players are paired here, not in the shards, so that everyone
+        # waits in the same queue. The games are placed as usual.
+        self.matchmaker = MatchMaker(self)
+
+        log.info("RoutingGameFactory_i created with %d shards.",
+                 len(shards))
+
+    def _shardIndex(self, name):
+        return zlib.crc32(name.encode("utf-8")) % len(self.shards)
+
+    def _shardFor(self, name):
+        return self.shards[self._shardIndex(name)]
+
+    @timed("GameFactory.newGame")
+    def newGame(self, name):
+        return self._shardFor(name).newGame(name)
+
+    @timed("GameFactory.findGame")
+    def findGame(self, name):
+        return self._shardFor(name).findGame(name)
+
+    @timed("GameFactory.listGames")
+    def listGames(self, how_many):
+        iter = MergedGameIterator_i(self, self.iterator_poa, self.shards)
+        ret, more = iter.next_n(how_many)
+
+        if more:
+            iobj = self._activateIterator(iter)
+        else:
+            iobj = None
+
+        return ret, iobj
+
+    @timed("GameFactory.describeGames")
+    def describeGames(self, names):
+        # One call to each shard holding any of the games
+        wanted = {}
+        for name in names:
+            wanted.setdefault(self._shardIndex(name), []).append(name)
+
+        found = {}
+        for i, shard_names in wanted.items():
+            for summary in self.shards[i].describeGames(shard_names):
+                found[summary.name] = summary
+
+        return [found[name] for name in names if name in found]
+
+    @timed("GameFactory.queryGames")
+    def queryGames(self, statuses, prefix, start_after, how_many):
+        # Every shard's first how_many matches include all of its games
+        # in the merged first how_many
+        how_many = int(how_many)
+        ret = []
+        more = False
+        for shard in self.shards:
+            seq, shard_more = shard.queryGames(statuses, prefix, start_after,
+                                               how_many)
+            ret.extend(seq)
+            more = more or shard_more
+
+        ret.sort(key=lambda info: info.name)
+        if len(ret) > how_many:
+            del ret[how_many:]
+            more = True
+
+        return ret, more
+
+    @timed("GameFactory.quickJoin")
+    def quickJoin(self, player, player_name):
+        return self.matchmaker.quickJoin(player, player_name)
+
+    @timed("GameFactory.subscribeLobby")
+    def subscribeLobby(self, listener):
+        with self.lobby_lock:
+            return self.lobby.subscribe(listener, self._lobbyGames)
+
+    def unsubscribeLobby(self, cookie):
+        self.lobby.unsubscribe(int(cookie))
+
+    def _lobbyGames(self):
+        return [game for shard in self.shard_lobbies
+                for game in shard.games.values()]
+
+
+class ShardLobby_i(TicTacToe__POA.LobbyListener):
+    """Follows the lobby feed of one shard, keeping a copy of its
+    lobby and republishing its changes in the routing factory's lobby.
+    If changes are missed, it subscribes again, and publishes the
+    differences between its copy and the new snapshot."""
+
+    def __init__(self, factory, poa, shard):
+        self.factory = factory
+        self.shard = shard
+        self.games = {}  # Name -> LobbyGame
+        self.version = 0
+        self.cookie = None
+        self.obj = poa.id_to_reference(poa.activate_object(self))
+        self.subscribe()
+
+    def subscribe(self):
+        with self.factory.lobby_lock:
+            if self.cookie is not None:
+                try:
+                    self.shard.unsubscribeLobby(self.cookie)
+                except CORBA.SystemException:
+                    pass
+
+            games, self.version, self.cookie = \
+                self.shard.subscribeLobby(self.obj)
+
+            current = dict((g.game.name, g) for g in games)
+            for name, game in list(self.games.items()):
+                if name not in current:
+                    self._apply(TicTacToe.GameRemoved, game)
+            for name, game in current.items():
+                old = self.games.get(name)
+                if old is None:
+                    self._apply(TicTacToe.GameAdded, game)
+                elif old.players != game.players:
+                    self._apply(TicTacToe.PlayersChanged, game)
+
+    def _apply(self, kind, game):
+        """Apply a change to our copy, and republish it. Called with
+        the factory's lobby_lock held."""
+        name = game.game.name
+        if kind == TicTacToe.GameAdded:
+            self.games[name] = game
+        elif kind == TicTacToe.GameRemoved:
+            if self.games.pop(name, None) is None:
+                return
+        else:
+            old = self.games.get(name)
+            if old is None:
+                return
+            self.games[name] = TicTacToe.LobbyGame(old.game, game.players)
+
+        obj = game.game.obj if kind == TicTacToe.GameAdded else None
+        self.factory.lobby.publish(kind, name, obj, game.players)
+
+    def lobbyChanged(self, changes):
+        with self.factory.lobby_lock:
+            for change in changes:
+                step = (change.version - self.version) & 0xffffffff
+                if step == 0 or step & 0x80000000:
+                    continue  # Already in the snapshot
+                if step != 1:
+                    break
+                self.version = change.version
+                self._apply(change.kind, change.game)
+            else:
+                return
+
+        log.warning("Missed lobby changes from a shard; resubscribing")
+        self.subscribe()
+
+
+class MergedGameIterator_i(TicTacToe__POA.GameIterator):
+    """Lists the games of each shard in turn. Each shard's listing is
+    only started once the ones before it have been exhausted."""
+
+    def __init__(self, factory, poa, shards):
+        self.factory = factory
+        self.poa = poa
+        self.pending = list(shards)  # Shard factories not yet listed
+        self.current = None          # Iterator of the shard being listed
+        self.deadline = time.monotonic() + factory.iterator_ttl
+
+    @timed("GameIterator.next_n")
+    def next_n(self, how_many):
+        self.deadline = time.monotonic() + self.factory.iterator_ttl
+        how_many = int(how_many)
+        ret = []
+
+        while len(ret) < how_many and (self.current or self.pending):
+            wanted = how_many - len(ret)
+
+            if self.current is None:
+                seq, self.current = self.pending.pop(0).listGames(wanted)
+            else:
+                seq, more = self.current.next_n(wanted)
+                if not more:
+                    self.current.destroy()
+                    self.current = None
+
+            ret.extend(seq)
+
+        more = self.current is not None or bool(self.pending)
+        return ret, more
+
+    def destroy(self):
+        if self.current is not None:
+            try:
+                self.current.destroy()
+            except CORBA.SystemException:
+                pass
+            self.current = None
+
+        id = self.poa.servant_to_id(self)
+        if self.factory._removeIterator(id):
+            self.poa.deactivate_object(id)
+
+
+def startWorkers(argv, count, context):
+    """Start count gameServer.py worker processes, and return their
+    factory references once they have all registered."""
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "gameServer.py")
+    names = [[CosNaming.NameComponent("GameFactory-%d" % i, "")]
+             for i in range(count)]
+
+    # Forget any workers left over from a previous run
+    for name in names:
+        try:
+            context.unbind(name)
+        except CosNaming.NamingContext.NotFound:
+            pass
+
+    workers = []
+    for i in range(count):
+        workers.append(subprocess.Popen([sys.executable, script,
+                                         "-shard", str(i)] + argv[1:]))
+
+    def stopWorkers():
+        for worker in workers:
+            worker.terminate()
+
+    atexit.register(stopWorkers)
+
+    shards = []
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    for i, name in enumerate(names):
+        while True:
+            try:
+                obj = context.resolve(name)
+                break
+            except CosNaming.NamingContext.NotFound:
+                if workers[i].poll() is not None:
+                    log.error("Worker %d exited during startup!", i)
+                    sys.exit(1)
+                if time.monotonic() > deadline:
+                    log.error("Timed out waiting for worker %d!", i)
+                    sys.exit(1)
+                time.sleep(0.1)
+
+        shards.append(obj._narrow(TicTacToe.GameFactory))
+
+    return shards
+
+
+def main(argv):
+    # The workers are given our arguments, including the ORB options
+    # that ORB_init() removes, less our own option
+    worker_argv = list(argv)
+    if "-shards" in worker_argv:
+        i = worker_argv.index("-shards")
+        del worker_argv[i:i + 2]
+
+    orb = CORBA.ORB_init(argv, CORBA.ORB_ID)
+
+    gameLog.start(getOption(argv, "-logLevel", gameLog.LOG_LEVEL))
+    log.info("Sharded Game Server starting...")
+
+    poa = orb.resolve_initial_references("RootPOA")
+    poa._get_the_POAManager().activate()
+
+    count = int(getOption(argv, "-shards", SHARDS))
+    iterator_ttl = float(getOption(argv, "-iteratorTTL", ITERATOR_TTL))
+
+    tutorialContext = getTutorialContext(orb)
+    shards = startWorkers(worker_argv, count, tutorialContext)
+
+    gf_impl = RoutingGameFactory_i(poa, shards, iterator_ttl)
+    gf_id = poa.activate_object(gf_impl)
+    gf_obj = poa.id_to_reference(gf_id)
+
+    print(orb.object_to_string(gf_obj))
+
+    tutorialContext.rebind([CosNaming.NameComponent("GameFactory", "")],
+                           gf_obj)
+    log.info("GameFactory bound in NameService.")
+
+    startStats(argv, poa, tutorialContext)
+
+    orb.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
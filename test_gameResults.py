@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# test_gameResults.py
+#
+# Round trips of the results file through ResultStore.
+
+import os
+import shutil
+import tempfile
+import unittest
+import TicTacToe
+
+from gameResults import ResultStore
+
+
+class TornTailTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "results")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def games(self, store):
+        return [r.name for r in reversed(store.recent("", 100))]
+
+    def test_torn_tail_is_truncated(self):
+        store = ResultStore(self.path)
+        store.record("one", "alice", "bob", TicTacToe.Nought, 5)
+        store.record("two", "alice", "bob", TicTacToe.Cross, 6)
+        store.file.close()
+        good = os.path.getsize(self.path)
+
+        # A record cut short by a crash
+        store = ResultStore(self.path)
+        store.record("three", "alice", "bob", TicTacToe.Nobody, 9)
+        store.file.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(good + 7)
+
+        store = ResultStore(self.path)
+        self.assertEqual(self.games(store), ["one", "two"])
+        self.assertEqual(os.path.getsize(self.path), good)
+
+        # Results appended after recovery survive the next restart
+        store.record("four", "bob", "alice", TicTacToe.Cross, 7)
+        store.file.close()
+
+        store = ResultStore(self.path)
+        store.file.close()
+        self.assertEqual(self.games(store), ["one", "two", "four"])
+        alice = store.player("alice")
+        self.assertEqual((alice.wins, alice.losses, alice.draws), (2, 1, 0))
+
+
+    def test_long_names_are_clipped(self):
+        name = "\u00e9" * 40000  # Two bytes each in UTF-8
+        store = ResultStore(self.path)
+        store.record("long", name, "bob", TicTacToe.Nought, 5)
+        store.file.close()
+
+        store = ResultStore(self.path)
+        store.file.close()
+        self.assertEqual(self.games(store), ["long"])
+        self.assertEqual(store.recent("", 1)[0].noughts, name[:32767])
+
+
+if __name__ == "__main__":
+    unittest.main()